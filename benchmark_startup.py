@@ -0,0 +1,48 @@
+# This script measures how long it takes to start the simulator, by timing
+# "import simulator" in fresh Python processes. Run it after changing any
+# imports to catch modules that make every run (and every sweep worker)
+# slower to start.
+#     example: python3 benchmark_startup.py --runs 10 --max 0.5
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+# Timed in the child process, so that starting Python itself isn't counted.
+# We also report whether importing the simulator pulled in matplotlib, which
+# should only be loaded once we plot.
+CHILD = """
+import time
+start = time.perf_counter()
+import simulator
+elapsed = time.perf_counter() - start
+import sys
+print(elapsed, "matplotlib" in sys.modules)
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--runs", type = int, default = 5,
+                    help = "number of fresh processes to time the import in")
+parser.add_argument("--max", type = float,
+                    help = "fail if the median import time is over this many "
+                           "seconds")
+args = parser.parse_args()
+
+here = os.path.dirname(os.path.abspath(__file__))
+times = []
+plotting = False
+for _ in range(args.runs):
+    output = subprocess.check_output([sys.executable, "-c", CHILD], \
+                                     cwd = here, universal_newlines = True)
+    (elapsed, loaded) = output.split()
+    times.append(float(elapsed))
+    plotting = plotting or loaded == "True"
+
+median = statistics.median(times)
+print("import simulator: median %.3f s, min %.3f s, max %.3f s over %d runs" \
+      % (median, min(times), max(times), args.runs))
+if plotting:
+    print("import simulator loaded matplotlib")
+if (args.max is not None and median > args.max):
+    sys.exit("Importing the simulator took longer than %.3f s" % args.max)
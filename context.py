@@ -0,0 +1,53 @@
+import globals
+from metrics import MetricStore
+
+class SimulationContext:
+    def __init__(self):
+        """This function initializes the state of a single run of the
+           simulator. Every Simulator has its own, and hands it to every
+           object it builds, so any number of simulations can be set up in
+           one process without touching each other. The settings are copied
+           from globals when the context is made, so changing globals
+           afterwards doesn't change a run that is already set up.
+           FIELDS-
+               systime : Time for the whole system (in s)
+               tick : The index of the current timestep, which statistics
+                      are recorded under
+               idmapping : Type: {id : object} mapping of the objects in the
+                           network, by 'hosts', 'links', 'routers' and
+                           'flows'
+               scheduler : The TickScheduler driving the run, while it is
+                           running
+               statistics : MetricStore holding a series for every tracked
+                            metric, keyed by "<object id>:<metric>". The
+                            Simulator replaces it with one sized for the run.
+               linkratewindow, flowratewindow : Length (in s) of the windows
+                            over which link rates and flow rates are
+                            estimated (globals.LINKRATEWINDOW and
+                            globals.FLOWRATEWINDOW)
+               rateestimator : How rates are estimated (globals.RATEESTIMATOR)
+               sampleinterval : How often (in s) each metric is sampled
+                                (globals.SAMPLEINTERVAL)
+               sampleaggregate : How each metric's samples are combined
+                                 (globals.SAMPLEAGGREGATE)
+               packetpool : Delivered ACK and control packets of the run,
+                            waiting to be reused by packet.make_packet"""
+        self.systime = 0
+        self.tick = 0
+        self.idmapping = {
+            'hosts' : {},
+
+            'links' : {},
+
+            'routers' : {},
+
+            'flows' : {}
+        }
+        self.scheduler = None
+        self.statistics = MetricStore()
+        self.linkratewindow = globals.LINKRATEWINDOW
+        self.flowratewindow = globals.FLOWRATEWINDOW
+        self.rateestimator = globals.RATEESTIMATOR
+        self.sampleinterval = dict(globals.SAMPLEINTERVAL)
+        self.sampleaggregate = dict(globals.SAMPLEAGGREGATE)
+        self.packetpool = []
@@ -1,16 +1,19 @@
 import globals
+from bisect import bisect_left
 
 from host import Host
 from link import Link
-from packet import Packet
+from packet import make_packet
 from router import Router
+from ratewindow import RateWindow
 
 class Flow_FAST:
-    def __init__(self, id, source, destination, amount,\
+    def __init__(self, context, id, source, destination, amount,\
                     start, track=True):
         """
         The function initializes a flow object:
         Initial Arguments:
+            - context (SimulationContext) : the run the flow is part of
             - id (string) : id of the flow
             - source (string): id of the source of the flow
             - destination (string): id of the destination of the flow
@@ -18,6 +21,7 @@ class Flow_FAST:
             - track (bool): used in determining if metrics should be tracked
 
         Attributes:
+            - context (SimulationContext) : the run the flow is part of
             - window_size (float) : size of the window used for sending packets
             - window_start (int) : packet number to start sending form
             - FR (int) : packet id of packet sent during fast recovery
@@ -31,7 +35,6 @@ class Flow_FAST:
             - setRTT (bool) : determine if we have set an RTT yet
             - state (string) : determines what start the congestion control is in
                 can take on values of "slow_start", "congestion_avoidance", "fast_recovery"
-            - packets (List<Packet>) : List of packets to be sent for the flow
             - done (bool) : flag to demonstrate if the flow has all been sent
             - ssthresh (int) : threshold for TCP Reno window size
             - send_times (dict) : dictionary of packet ids to send times of the packet
@@ -73,13 +76,11 @@ class Flow_FAST:
 
             Variables for metric tracking:
             - track
-            - frwindow
-            - frsteps
-            - rttwindow
-            - rttsteps
-            - added
+            - flowrate : RateWindow estimating the flow rate from the data
+                newly acknowledged in each time step
             - successfullytransmitted
             - states_tracker : tracks the states the flow is in and when they switch"""
+        self.context = context
         # current size of the window used for the congestion controller
         self.window_size = 1
         self.window_start = 0
@@ -90,14 +91,10 @@ class Flow_FAST:
         self.rto = self.rtt
         self.id = id
 
-        if source[0] == 'H':
-            self.source = globals.idmapping['hosts'][source]
-        else:
-            self.source = globals.idmapping['routers'][source]
-        if destination[0] == 'H':
-            self.destination = globals.idmapping['hosts'][destination]
-        else:
-            self.destination = globals.idmapping['routers'][destination]
+        # These are the ids until Simulator.compile_topology replaces them
+        # with the objects
+        self.source = source
+        self.destination = destination
 
         # converts the amount of data from Megabytes to bits
         self.amount = round((amount * 8 * globals.MEGABITSTOBITS) / (globals.PACKETSIZE - (20 * 8))) + 1
@@ -108,21 +105,15 @@ class Flow_FAST:
 
         self.setRTT = False
         self.state = "slow_start"
-        # list of actual packets to be sent
-        self.packets = []
-
-        for i in range(self.amount):
-            p = None
-            p = Packet(self.source.id, self.id, self.destination.id, i, \
-                globals.STANDARDPACKET, '')
-            self.packets.append(p)
-
 
         # flag to demonstrate if the flow has all been sent
         self.done = False
         self.ssthresh = 1000
         # packets that have been sent but not acknowledged yet
         self.send_times = dict()
+        # smallest packet id that hasn't been sent (since the last timeout),
+        # every packet from here on is missing from send_times
+        self.next_unsent = 0
         # used to calculate RTT
         self.dup_count = dict()
         # congestion signals to keep track of
@@ -134,9 +125,7 @@ class Flow_FAST:
 
         # Variables for metric tracking
         self.track = track
-        self.frwindow = 600 * globals.dt
-        self.frsteps = []
-        self.added = False
+        self.flowrate = RateWindow(context.flowratewindow, context.rateestimator)
         self.successfullytransmitted = {}
 
         ### DECLARATIONS FOR FAST FLOW
@@ -166,16 +155,25 @@ class Flow_FAST:
         self.actual_packets_received = 0
 
 
-        # If this flow is being tracked, we set up the dictionaries for all of
+        # If this flow is being tracked, we set up the series for all of
         # the metrics to be tracked.
+        self.series = {}
         if (track):
             for m in globals.FLOWMETRICS:
-                globals.statistics[id+":"+m] = {}
+                self.series[m] = self.context.statistics.add_series(id+":"+m)
 
 
         # tracking what states we are in and the time
         self.states_tracker = []
 
+    '''
+    Builds packet i of the flow when it needs to be (re)sent. Packets are never
+    changed once they're sent, so we don't need to keep them around.
+    '''
+    def packet(self, i):
+        return make_packet(self.context, self.source.id, self.id, \
+            self.destination.id, i, globals.STANDARDPACKET, '')
+
     '''
     Called every time increment.
 
@@ -188,7 +186,7 @@ class Flow_FAST:
     '''
     def run(self):
         # if we shouldn't do anything, leave
-        if self.start >= globals.systime or self.done == True:
+        if self.start >= self.context.systime or self.done == True:
             return
 
         # this has to happen every dt
@@ -252,7 +250,7 @@ class Flow_FAST:
 
                     self.goal_window = self.next_window
 
-                    self.states_tracker.append((self.state, globals.systime))
+                    self.states_tracker.append((self.state, self.context.systime))
 
 
                 if self.state == 'congestion_avoidance':
@@ -278,6 +276,21 @@ class Flow_FAST:
         self.send_packets()
 
 
+    '''
+    Earliest time at which run() has work to do without receiving an ACK.
+
+    Before the flow starts this is the start time. Once running, the window
+    moves every dt, so the flow wants to run at the very next timestep. None
+    once we're done.
+    '''
+    def next_event_time(self):
+        if self.done:
+            return None
+        if self.start >= self.context.systime:
+            return self.start
+        return self.context.systime
+
+
     '''
     p is the packet that we are acknowledging.
 
@@ -312,7 +325,7 @@ class Flow_FAST:
 
         # if this is first successful transmission of packet, set new rtt & rto
         if self.dup_count[p.packetid] == 1:
-            self.rtt = globals.systime - self.send_times[p.packetid]
+            self.rtt = self.context.systime - self.send_times[p.packetid]
             self.rto = 2 * self.rtt
             self.rtt_interval_size = self.rtt
 
@@ -321,7 +334,7 @@ class Flow_FAST:
                 self.min_rtt = self.rtt
 
         # this is a new ACK, update timeout_marker
-        self.timeout_marker = globals.systime + self.rto
+        self.timeout_marker = self.context.systime + self.rto
 
         # if it's the synack, start metrics
         if p.packetid == 0:
@@ -338,7 +351,7 @@ class Flow_FAST:
 
             self.goal_window = self.next_window
 
-            self.states_tracker.append((self.state, globals.systime))
+            self.states_tracker.append((self.state, self.context.systime))
 
         # handling by state
         if self.state == 'congestion_avoidance':
@@ -374,7 +387,7 @@ class Flow_FAST:
 
             self.goal_window = self.next_window
 
-            self.states_tracker.append((self.state, globals.systime))
+            self.states_tracker.append((self.state, self.context.systime))
 
     '''
     p is the packet that we are acknowledging.
@@ -409,14 +422,14 @@ class Flow_FAST:
             self.state = 'fast_recovery'
 
             # retransmit
-            self.source.send_packet(self.packets[p.data])
+            self.source.send_packet(self.packet(p.data))
             self.dup_count[p.data] = self.dup_count[p.data] + 1
 
             # window modifications
             self.ssthresh = self.window_size / 2
             self.window_size = self.ssthresh + 3
 
-            self.states_tracker.append((self.state, globals.systime))
+            self.states_tracker.append((self.state, self.context.systime))
 
 
         elif self.state == 'fast_recovery':
@@ -436,8 +449,8 @@ class Flow_FAST:
     # gets called every dt
     def send_packets(self):
         # if we have timed out (not recently)
-        if globals.systime >= self.timeout_marker and \
-            globals.systime >= self.next_cut_time:
+        if self.context.systime >= self.timeout_marker and \
+            self.context.systime >= self.next_cut_time:
 
             # enter slow_start
             self.ssthresh = self.window_size / 2
@@ -445,8 +458,8 @@ class Flow_FAST:
             self.window_size = 1
 
             self.state = 'slow_start'
-            self.next_cut_time = globals.systime + self.rto
-            self.states_tracker.append((self.state, globals.systime))
+            self.next_cut_time = self.context.systime + self.rto
+            self.states_tracker.append((self.state, self.context.systime))
 
 
             # rtt interval stuff
@@ -459,8 +472,8 @@ class Flow_FAST:
             # we dont have an estimate anymore, so set it to -1
             self.estimate_packets_received = -1
 
-            self.source.send_packet(self.packets[self.window_start])
-            self.send_times[self.window_start] = globals.systime
+            self.source.send_packet(self.packet(self.window_start))
+            self.send_times[self.window_start] = self.context.systime
             self.dup_count[self.window_start] += 1
 
             # clear out the send times for all the packets larger than
@@ -469,6 +482,8 @@ class Flow_FAST:
             for i in send_times_keys_copy:
                 if i > self.window_start:
                     del self.send_times[i]
+            # so everything after it needs to be sent again
+            self.next_unsent = self.window_start + 1
 
             self.rto = 2 * self.rto
             self.next_cut_time += self.rto
@@ -483,20 +498,23 @@ class Flow_FAST:
     been sent.
     '''
     def send_window(self):
-        # send everything in the window that has not been sent
-        for i in range(self.window_start, min(round(self.window_start + self.window_size), self.amount)):
-            if i not in self.send_times.keys():
-                # update duplicate counter
-                if i not in self.dup_count.keys():
-                    self.dup_count[i] = 1
-                else:
-                    self.dup_count[i] += 1
+        # everything before next_unsent has been sent (or, if the window starts
+        # after it, acknowledged), so only look at the part of the window that
+        # has opened up since the last call
+        end = min(round(self.window_start + self.window_size), self.amount)
+        for i in range(max(self.window_start, self.next_unsent), end):
+            # update duplicate counter
+            if i not in self.dup_count:
+                self.dup_count[i] = 1
+            else:
+                self.dup_count[i] += 1
 
-                # update the sent time
-                self.send_times[i] = globals.systime
+            # update the sent time
+            self.send_times[i] = self.context.systime
 
-                # send the packet
-                self.source.send_packet(self.packets[i])
+            # send the packet
+            self.source.send_packet(self.packet(i))
+        self.next_unsent = max(self.next_unsent, self.window_start, end)
 
 
     '''
@@ -505,19 +523,17 @@ class Flow_FAST:
     def start_metrics(self):
         self.setRTT = True
         if ((self.track) and globals.FLOWRTT in globals.FLOWMETRICS):
-            key = self.id + ":" + globals.FLOWRTT
-            globals.statistics[key][globals.systime] = self.rtt
+            self.series[globals.FLOWRTT].record(self.context.tick, self.rtt)
         return
 
     '''
     Handles tracking metrics for this flow.
     '''
     def track_metrics(self, p):
-        if self.track and (not self.done) and globals.systime >= self.start and \
+        if self.track and (not self.done) and self.context.systime >= self.start and \
            p.packetid not in self.successfullytransmitted.keys():
             self.successfullytransmitted[p.packetid] = 1
-            self.added = True
-            self.frsteps.append(globals.PACKETSIZE)
+            self.flowrate.add(globals.PACKETSIZE)
 
 
     '''
@@ -525,31 +541,40 @@ class Flow_FAST:
     '''
     # Update the flow statistics for metric tracking
     def update_flow_statistics(self):
-        if self.track and (not self.done) and globals.systime >= self.start:
+        if self.track and (not self.done) and self.context.systime >= self.start:
             # Flow Rate
-            if (not self.added):
-                self.frsteps.append(0)
-            rate = 0
-            if (len(self.frsteps) <= self.frwindow/globals.dt):
-                if (globals.systime > self.start):
-                    rate = sum(self.frsteps)/(globals.systime - self.start)
-            else:
-                self.frsteps.pop(0)
-                rate = sum(self.frsteps)/(self.frwindow)
-            key = self.id + ":" + globals.FLOWRATE
-            globals.statistics[key][globals.systime] = rate
+            self.flowrate.step(self.context.systime - self.start)
+            rate = self.flowrate.rate()
+            self.series[globals.FLOWRATE].record(self.context.tick, rate)
 
             # Window Size
-            key = self.id + ":" + globals.WINDOWSIZE
-            globals.statistics[key][globals.systime] = self.window_size
+            self.series[globals.WINDOWSIZE].record(self.context.tick, self.window_size)
 
             # RTT
             if self.setRTT:
-                key = self.id + ":" + globals.FLOWRTT
-                globals.statistics[key][globals.systime] = self.rtt
+                self.series[globals.FLOWRTT].record(self.context.tick, self.rtt)
 
-        self.added = False
 
+    '''
+    Does the work of update_flow_statistics for each of the timesteps from
+    tick on (whose values of systime are times) all at once, for a stretch of
+    timesteps in which the flow had nothing to do.
+    '''
+    def fill_flow_statistics(self, tick, times):
+        if self.track and (not self.done):
+            # Only the timesteps from the start of the flow on are recorded
+            skip = bisect_left(times, self.start)
+            times = times[skip:]
+            tick = tick + skip
+            if (len(times) == 0):
+                return
+            rates = self.flowrate.fill(0, [t - self.start for t in times])
+            self.series[globals.FLOWRATE].record_many(tick, rates)
+            self.series[globals.WINDOWSIZE].record_range(tick, len(times), \
+                                                         self.window_size)
+            if (self.setRTT):
+                self.series[globals.FLOWRTT].record_range(tick, len(times), \
+                                                          self.rtt)
 
     '''
     Whether or not the flow is done.
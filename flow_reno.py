@@ -1,17 +1,20 @@
 import globals
 import math
+from bisect import bisect_left
 
 from host import Host
 from link import Link
-from packet import Packet
+from packet import make_packet
 from router import Router
+from ratewindow import RateWindow
 
 class Flow:
-    def __init__(self, id, source, destination, amount,\
+    def __init__(self, context, id, source, destination, amount,\
                     start, track=True):
         '''
         The function initializes a flow object:
         Initial Arguments:
+            - context (SimulationContext) : the run the flow is part of
             - id (string) : id of the flow
             - source (string): id of the source of the flow
             - destination (string): id of the destination of the flow
@@ -19,6 +22,7 @@ class Flow:
             - track (bool): used in determining if metrics should be tracked
 
         Attributes:
+            - context (SimulationContext) : the run the flow is part of
             - window_size (float) : size of the window used for sending packets
             - window_start (int) : packet number to start sending form
             - FR (int) : packet id of packet sent during fast recovery
@@ -32,11 +36,12 @@ class Flow:
             - setRTT (bool) : determine if we have set an RTT yet
             - state (string) : determines what start the congestion control is in
                 can take on values of "slow_start", "congestion_avoidance", "fast_recovery"
-            - packets (List<Packet>) : List of packets to be sent for the flow
             - done (bool) : flag to demonstrate if the flow has all been sent
             - ssthresh (int) : threshold for TCP Reno window size
             - send_times (dict) : dictionary of packet ids to send times of the packet
                  contains only packets that have not yet been acked
+            - next_unsent (int) : smallest packet id that hasn't been sent (since the
+                last timeout). Every packet from here on is missing from send_times.
             - dup_count (dict) : a dictionary of packet id and the number of times they
                 have been sent, used to calculate the RTT using Karn's algo
             - duplicate_count (int) : number of consecutive duplicative acks received
@@ -47,14 +52,12 @@ class Flow:
 
             Variables for metric tracking:
             - track
-            - frwindow
-            - frsteps
-            - rttwindow
-            - rttsteps
-            - added
+            - flowrate : RateWindow estimating the flow rate from the data
+                newly acknowledged in each time step
             - successfullytransmitted
             - states_tracker : tracks the states the flow is in and when they switch.
         '''
+        self.context = context
         self.window_size = 1
         self.window_start = 0
         self.FR = -1
@@ -63,14 +66,10 @@ class Flow:
         self.rto = self.rtt
         self.id = id
 
-        if source[0] == 'H':
-            self.source = globals.idmapping['hosts'][source]
-        else:
-            self.source = globals.idmapping['routers'][source]
-        if destination[0] == 'H':
-            self.destination = globals.idmapping['hosts'][destination]
-        else:
-            self.destination = globals.idmapping['routers'][destination]
+        # These are the ids until Simulator.compile_topology replaces them
+        # with the objects
+        self.source = source
+        self.destination = destination
 
         # Converts the amount of data from Megabytes to bits
         self.amount = round((amount * 8 * globals.MEGABITSTOBITS) / (globals.PACKETSIZE - (20 * 8))) + 1
@@ -80,19 +79,13 @@ class Flow:
 
         self.setRTT = False
         self.state = "slow_start"
-        # List of actual packets to be sent
-        self.packets = []
-        for i in range(self.amount):
-            p = None
-            p = Packet(self.source.id, self.id, self.destination.id, i, \
-                globals.STANDARDPACKET, '')
-            self.packets.append(p)
 
         self.done = False
         self.ssthresh = 1000
 
         self.send_times = dict()
         self.dup_count = dict()
+        self.next_unsent = 0
 
         # congestion signals to keep track of
         self.duplicate_count = 0
@@ -102,30 +95,44 @@ class Flow:
 
         # Variables for metric tracking
         self.track = track
-        self.frwindow = 600 * globals.dt
-        self.frsteps = []
-        self.added = False
+        self.flowrate = RateWindow(context.flowratewindow, context.rateestimator)
         self.successfullytransmitted = {}
 
-        # If this flow is being tracked, we set up the dictionaries for all of
+        # If this flow is being tracked, we set up the series for all of
         # the metrics to be tracked.
+        self.series = {}
         if (track):
             for m in globals.FLOWMETRICS:
-                globals.statistics[id+":"+m] = {}
+                self.series[m] = self.context.statistics.add_series(id+":"+m)
         # Tracking what states we are in and the time
         self.states_tracker = []
 
 
 
+    # Builds packet i of the flow when it needs to be (re)sent. Packets are
+    # never changed once they're sent, so we don't need to keep them around.
+    def packet(self, i):
+        return make_packet(self.context, self.source.id, self.id, \
+            self.destination.id, i, globals.STANDARDPACKET, '')
+
     # Run the flow, this is the function called every dt for the flow
     def run(self):
         # If we shouldn't do anything, leave
-        if self.start >= globals.systime or self.done == True:
+        if self.start >= self.context.systime or self.done == True:
             return
 
         # Send any available packets otherwise
         self.send_packets()
 
+    # Earliest time at which run() has work to do without receiving an ACK:
+    # the flow start, or the retransmission timeout. None once we're done.
+    def next_event_time(self):
+        if self.done:
+            return None
+        if self.start >= self.context.systime:
+            return self.start
+        return max(self.timeout_marker, self.next_cut_time)
+
     # Process an acknowledgement once received
     def process_ack(self, p):
         # If we've received the acknowledgment for the last packet
@@ -143,7 +150,7 @@ class Flow:
         # If we're in fast_recovery with a new packet, enter congestion_avoidance
         if self.state == 'fast_recovery':
             self.state = 'congestion_avoidance'
-            self.states_tracker.append((self.state, globals.systime))
+            self.states_tracker.append((self.state, self.context.systime))
 
         self.duplicate_count = 0
         self.duplicate_packet = p.data
@@ -151,11 +158,11 @@ class Flow:
 
         # If this is first successful transmission of packet, set new rtt & rto
         if self.dup_count[p.packetid] == 1:
-            self.rtt = globals.systime - self.send_times[p.packetid]
+            self.rtt = self.context.systime - self.send_times[p.packetid]
             self.rto = 2 * self.rtt
 
         # This is a new ACK, update rto
-        self.timeout_marker = globals.systime + self.rto
+        self.timeout_marker = self.context.systime + self.rto
 
         # If it's the synack, start metrics
         if p.packetid == 0:
@@ -165,7 +172,7 @@ class Flow:
         # If we hit the threshold, enter congestion avoidance
         if self.window_size >= self.ssthresh and self.state == 'slow_start':
             self.state = 'congestion_avoidance'
-            self.states_tracker.append((self.state, globals.systime))
+            self.states_tracker.append((self.state, self.context.systime))
 
         # Slow start
         if self.state == 'slow_start':
@@ -188,15 +195,15 @@ class Flow:
         self.duplicate_count += 1
         # Time to enter fast recovery
         if self.state != 'fast_recovery' and self.duplicate_count == 3 and \
-                      self.next_cut_time <= globals.systime:
+                      self.next_cut_time <= self.context.systime:
             self.ssthresh = max(self.window_size / 2, 2)
             # Retransmit the dropped packet
-            self.source.send_packet(self.packets[p.data])
+            self.source.send_packet(self.packet(p.data))
             self.dup_count[p.data] = self.dup_count[p.data] + 1
             self.window_size = self.ssthresh + 3
             self.state = 'fast_recovery'
-            self.states_tracker.append((self.state, globals.systime))
-            self.next_cut_time = globals.systime + self.rto
+            self.states_tracker.append((self.state, self.context.systime))
+            self.next_cut_time = self.context.systime + self.rto
 
         # Window inflation
         elif self.state == 'fast_recovery':
@@ -206,22 +213,22 @@ class Flow:
     # Sends the packets depending on the time and acks we've received
     def send_packets(self):
         # if we have timed out (not recently)
-        if globals.systime >= self.timeout_marker and \
-            globals.systime >= self.next_cut_time:
-            print("timed out at time: ", globals.systime, "window size: ", self.window_size)
+        if self.context.systime >= self.timeout_marker and \
+            self.context.systime >= self.next_cut_time:
+            print("timed out at time: ", self.context.systime, "window size: ", self.window_size)
             # Enter slow_start
             self.ssthresh = max(self.window_size / 2, 2)
             self.window_size = 1
 
             # Update state and track timeout
             self.state = 'slow_start'
-            self.next_cut_time = globals.systime + self.rto
-            self.states_tracker.append((self.state, globals.systime))
+            self.next_cut_time = self.context.systime + self.rto
+            self.states_tracker.append((self.state, self.context.systime))
 
             # Retransmit timed out packet and update send times and
             #    dup_count
-            self.source.send_packet(self.packets[self.window_start])
-            self.send_times[self.window_start] = globals.systime
+            self.source.send_packet(self.packet(self.window_start))
+            self.send_times[self.window_start] = self.context.systime
             self.dup_count[self.window_start] += 1
 
             # Clear out the send times for all the packets larger than
@@ -230,6 +237,8 @@ class Flow:
             for i in send_times_keys_copy:
                 if i > self.window_start:
                     del self.send_times[i]
+            # So everything after it needs to be sent again
+            self.next_unsent = self.window_start + 1
 
             # Double timeout time
             self.rto = 2 * self.rto
@@ -241,28 +250,29 @@ class Flow:
 
     # Send a window of packets if it has not been sent
     def send_window(self):
-        # Send everything in the window that has not been sent
-        for i in range(self.window_start, min(round(self.window_start + \
-             self.window_size), self.amount)):
-            if i not in self.send_times.keys():
-                # update duplicate counter
-                if i not in self.dup_count.keys():
-                    self.dup_count[i] = 1
-                else:
-                    self.dup_count[i] += 1
-
-                # update the sent time
-                self.send_times[i] = globals.systime
-
-                # send the packet
-                self.source.send_packet(self.packets[i])
+        # Everything before next_unsent has been sent (or, if the window
+        # starts after it, acknowledged), so we only need to look at the part
+        # of the window that has opened up since the last call
+        end = min(round(self.window_start + self.window_size), self.amount)
+        for i in range(max(self.window_start, self.next_unsent), end):
+            # update duplicate counter
+            if i not in self.dup_count:
+                self.dup_count[i] = 1
+            else:
+                self.dup_count[i] += 1
+
+            # update the sent time
+            self.send_times[i] = self.context.systime
+
+            # send the packet
+            self.source.send_packet(self.packet(i))
+        self.next_unsent = max(self.next_unsent, self.window_start, end)
 
     # Initialize info to start tracking metrics for the flow
     def start_metrics(self):
         self.setRTT = True
         if (self.track):
-            key = self.id + ":" + globals.FLOWRTT
-            globals.statistics[key][globals.systime] = self.rtt
+            self.series[globals.FLOWRTT].record(self.context.tick, self.rtt)
         return
 
     # Track the metrics on the flow
@@ -270,36 +280,43 @@ class Flow:
         if self.track and (not self.done) and \
            p.packetid not in self.successfullytransmitted.keys():
             self.successfullytransmitted[p.packetid] = 1
-            self.frsteps.append(globals.PACKETSIZE)
-            self.added = True
-            assert globals.systime >= self.start
+            self.flowrate.add(globals.PACKETSIZE)
+            assert self.context.systime >= self.start
 
 
     # Update the flow statistics for metric tracking
     def update_flow_statistics(self):
-        if self.track and (not self.done) and globals.systime >= self.start:
+        if self.track and (not self.done) and self.context.systime >= self.start:
             # Flow Rate
-            rate = 0
-            if (not self.added):
-                self.frsteps.append(0)
-            if (len(self.frsteps) <= self.frwindow/globals.dt):
-                rate = sum(self.frsteps)/(globals.systime - self.start)
-            else:
-                self.frsteps.pop(0)
-                rate = sum(self.frsteps)/(self.frwindow)
-            key = self.id + ":" + globals.FLOWRATE
-            globals.statistics[key][globals.systime] = rate
+            self.flowrate.step(self.context.systime - self.start)
+            rate = self.flowrate.rate()
+            self.series[globals.FLOWRATE].record(self.context.tick, rate)
 
             # Window size
-            key = self.id + ":" + globals.WINDOWSIZE
-            globals.statistics[key][globals.systime] = self.window_size
+            self.series[globals.WINDOWSIZE].record(self.context.tick, self.window_size)
 
             # RTT
             if (self.setRTT):
-                key = self.id + ":" + globals.FLOWRTT
-                globals.statistics[key][globals.systime] = self.rtt
-
-        self.added = False
+                self.series[globals.FLOWRTT].record(self.context.tick, self.rtt)
+
+    # Does the work of update_flow_statistics for each of the timesteps from
+    # tick on (whose values of systime are times) all at once, for a stretch
+    # of timesteps in which the flow had nothing to do
+    def fill_flow_statistics(self, tick, times):
+        if self.track and (not self.done):
+            # Only the timesteps from the start of the flow on are recorded
+            skip = bisect_left(times, self.start)
+            times = times[skip:]
+            tick = tick + skip
+            if (len(times) == 0):
+                return
+            rates = self.flowrate.fill(0, [t - self.start for t in times])
+            self.series[globals.FLOWRATE].record_many(tick, rates)
+            self.series[globals.WINDOWSIZE].record_range(tick, len(times), \
+                                                         self.window_size)
+            if (self.setRTT):
+                self.series[globals.FLOWRTT].record_range(tick, len(times), \
+                                                          self.rtt)
 
     # Function to determine if the flow has completed or not
     def completed(self):
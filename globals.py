@@ -7,31 +7,15 @@ from packet import Packet
 Initializes the globals class.
 
 This class is where we store all the global variables used within the simulator.
-We keep track of the dt, the total simulation time, and various other metrics
-and constants.
+We keep track of the dt, the default settings of a run, and various other metrics
+and constants. The state of each run is kept in its SimulationContext (see
+context.py).
 '''
 def initialize():
-    # Time for the whole system
-    global systime
-    systime = 0
-
     # Time increment settings, with dt = 0.0001
     global dt
     dt = 1 * (10**-4)
 
-    # Type: {id : object} mapping of the objects in the network
-    global idmapping
-    idmapping = {
-        'hosts' : {},
-
-        'links' : {},
-
-        'routers' : {},
-
-        'flows' : {}
-    }
-
-
     # Conversion constants.
     global MEGABITSTOBITS
     MEGABITSTOBITS = 10**6
@@ -54,8 +38,17 @@ def initialize():
     global PRESENTATIONMODE
     PRESENTATIONMODE = True
 
-    global statistics
-    statistics = {}
+    # Length (in seconds) of the windows over which link rates and flow rates
+    # are estimated, and whether the estimate is a plain average over the
+    # window ("window") or an exponentially weighted moving average ("ewma").
+    global LINKRATEWINDOW
+    LINKRATEWINDOW = 5000 * dt
+
+    global FLOWRATEWINDOW
+    FLOWRATEWINDOW = 600 * dt
+
+    global RATEESTIMATOR
+    RATEESTIMATOR = "window"
 
     global LINKRATE
     LINKRATE = "link rate"
@@ -87,6 +80,27 @@ def initialize():
     global FLOWMETRICS
     FLOWMETRICS = [WINDOWSIZE, FLOWRATE, FLOWRTT]
 
+    # How often (in seconds) each metric is sampled. By default we keep a
+    # sample for every timestep. The host flow rate isn't recorded, but built
+    # from the flow rates when it is plotted, so it is sampled like them.
+    global SAMPLEINTERVAL
+    SAMPLEINTERVAL = {m : dt for m in LINKMETRICS + HALFLINKMETRICS + \
+                      FLOWMETRICS}
+
+    # How the values recorded within one sampling interval are combined into
+    # a sample: "last", "mean", "max" or "sum".
+    global SAMPLEAGGREGATE
+    SAMPLEAGGREGATE = {
+        LINKRATE : "mean",
+        # Keep the peaks, which is what we care about with the buffers
+        BUFFEROCCUPANCY : "max",
+        # Count every packet dropped in the interval
+        PACKETLOSS : "sum",
+        WINDOWSIZE : "last",
+        FLOWRATE : "mean",
+        FLOWRTT : "mean"
+    }
+
     global PACKETSIZE
     PACKETSIZE = 1024*8
 
@@ -96,26 +110,27 @@ def initialize():
     global HANDSIZE
     HANDSIZE = 64 * 8
 
+    # Packet types are small integers so that checking them is cheap
     global STANDARDPACKET
-    STANDARDPACKET = 'standard_packet'
+    STANDARDPACKET = 0
 
     global ACKPACKET
-    ACKPACKET = 'ack_packet'
+    ACKPACKET = 1
 
     global ROUTINGPACKET
-    ROUTINGPACKET = 'routing_packet'
+    ROUTINGPACKET = 2
 
     global HANDSHAKEPACKET
-    HANDSHAKEPACKET = 'handshake_packet'
+    HANDSHAKEPACKET = 3
 
     global HANDSHAKEACK
-    HANDSHAKEACK = 'handshake_ack'
+    HANDSHAKEACK = 4
 
     global SYNPACKET
-    SYNPACKET = "syn_packet"
+    SYNPACKET = 5
 
     global SYNACK
-    SYNACK = "syn_ack"
+    SYNACK = 6
 
     global PACKETHEADERSIZE
     PACKETHEADERSIZE = 20 * 8
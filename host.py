@@ -1,36 +1,51 @@
 import globals
-from packet import Packet
+from packet import make_packet, release
 from link import Link
+from scoreboard import Scoreboard
 
 # This class simulates the behavior of a host in our network
 class Host:
     """
     This function initializes a host object. Input arguments:
+        - context : the SimulationContext of the run the host is part of
         - hostid : the string id of the host object
         - linkid : the id of the link associated with the host
 
         Attributes :
+        - context : the SimulationContext of the run the host is part of
         - ip : ip address associated with the host
-        - flow_packets_seen : dictionary of flows to packets seen
+        - flow_packets_seen : dictionary of flows to the Scoreboard of packets
+                              seen
+        - link : the link associated with the host
+        - halflink : the half link the host sends packets down
+        - flows : dictionary of id : flow, for the flows coming out of the host
+        (link, halflink and flows are filled in by Simulator.compile_topology)
     """
-    def __init__(self, hostid, linkid):
+    def __init__(self, context, hostid, linkid):
+        self.context = context
         self.id = hostid
         self.ip = 0
         self.linkid = linkid
+        self.link = None
+        self.halflink = None
+        self.flows = {}
 
         # NOTE: this is the dictionary of flows to packets seen
-        # say there are 3 flows
+        # say there are 3 flows, where we have seen
         #       'flow1id' : [0, 1, 2, 3]
         #       'flow2id' : [0, 1, 2, 3, 4, 6, 7, 8, 9]
         #       'flow3id' : [0, 1]
+        # we only keep the first packet we're still missing, and the packets
+        # we've seen after it (see scoreboard.py)
+        #       'flow1id' : expected 4, outoforder {}
+        #       'flow2id' : expected 5, outoforder {6, 7, 8, 9}
+        #       'flow3id' : expected 2, outoforder {}
         self.flow_packets_seen = {}
 
     # Sends the packet by adding (or attempting to add) the packet the link
     # buffer
     def send_packet(self, p):
-        # Get the actual link object
-        connected_link = globals.idmapping['links'][self.linkid]
-        connected_link.add_to_buffer(p, self.id)
+        self.halflink.send(p)
     
     # Sends acknowledgements of packets received and notifies the correct flow
     def receive_packet(self, p, linkid):
@@ -39,46 +54,42 @@ class Host:
         # If it's a handshake packet
         if (p.get_packet_type() == globals.HANDSHAKEPACKET):
             # Send handshake back
-            data = self.id + " " + str(globals.systime)
-            ack = Packet(self.id, None, p.get_source(), None, \
-                            globals.HANDSHAKEACK, data = data)
+            data = self.id + " " + str(self.context.systime)
+            ack = make_packet(self.context, self.id, None, p.get_source(), \
+                              None, globals.HANDSHAKEACK, data = data)
             self.send_packet(ack)
 
         # If it's a standard packet, it's from a flow
         elif (p.get_packet_type() == globals.STANDARDPACKET):
-            # If we've already seen the flow before, add to its dict
-            if flowid in self.flow_packets_seen.keys():
-                # If the packet is a new packet, add it in the right spot
-                if p.get_packetid() not in self.flow_packets_seen[flowid]:
-                    self.flow_packets_seen[flowid].append(p.get_packetid())
-                    self.flow_packets_seen[flowid] = sorted(self.flow_packets_seen[flowid])
-                # Otherwise, do nothing
-
-            # Otherwise, it's a new flow and we need to add it to the dict
-            else:
-                self.flow_packets_seen[flowid] = [p.get_packetid()]
+            # If it's a new flow, start keeping track of it
+            if flowid not in self.flow_packets_seen:
+                self.flow_packets_seen[flowid] = Scoreboard()
 
             # Now we need to send an ack back!
             # So, we need to find the smallest number that has not been
             # received in the sequence
-            packetid_needed = -1
-            packets_gotten = self.flow_packets_seen[flowid]
-            for i in range(len(packets_gotten)):
-                # If we have seen a packet id and the next one has also been
-                # seen, then update the packet_needed
-                if packetid_needed + 1 == packets_gotten[i]:
-                    packetid_needed += 1
-                else:
-                    break
+            packetid_needed = \
+                self.flow_packets_seen[flowid].receive(p.get_packetid())
             # We now have the smallest value that is missing consecutively
             # Time to send the ack packets
-            ack = Packet(self.id, flowid, p.get_source(), p.get_packetid(), \
-                            globals.ACKPACKET, data = packetid_needed + 1)
+            ack = make_packet(self.context, self.id, flowid, \
+                              p.get_source(), p.get_packetid(), \
+                              globals.ACKPACKET, data = packetid_needed)
             self.send_packet(ack)
+            release(self.context, p)
 
         # If it's an acknowledgement, let the flow know we received it
         elif (p.get_packet_type() == globals.ACKPACKET):
             flowid = p.get_flowid()
-            flow = globals.idmapping['flows'][flowid]
+            flow = self.flows[flowid]
+            # The ACK changes the flow's state, so the scheduler needs to
+            # run it this timestep.
+            if self.context.scheduler is not None:
+                self.context.scheduler.wake_flow(flow)
             # Process the acknowledgement
             flow.process_ack(p)
+            release(self.context, p)
+
+        # Hosts don't use link states or handshake acknowledgements
+        else:
+            release(self.context, p)
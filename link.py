@@ -1,10 +1,12 @@
 import globals
 from packet import Packet
+from ratewindow import RateWindow
 
 class Link:
-    def __init__(self, linkid, connection1, connection2, rate, delay, buffersize, track1=True, track2=True):
+    def __init__(self, context, linkid, connection1, connection2, rate, delay, buffersize, track1=True, track2=True):
         """This function initializes new link objects
            INPUT ARGUMENTS-
+               context : The SimulationContext of the run the link is part of
                linkid : The string ID of the link being constructed
                connection1 : The string ID of the object connected to one side
                              of the link
@@ -20,6 +22,7 @@ class Link:
                         should be tracked in the connection2 -> connection1
                         direction
            FIELDS-
+               context : The SimulationContext of the run the link is part of
                links : A dictionary with entries of the form ID : half link,
                        where ID specifies the ID of the object that will be
                        be sending things along that half link.
@@ -37,9 +40,10 @@ class Link:
         self.delay = delay * globals.MSTOS
 
         # Initializes both HaflLinks associated with this Link.
-        self.links = {connection1: HalfLink(linkid, connection1, connection2, self.rate, self.delay, buffer, track1),  \
-                      connection2: HalfLink(linkid, connection2, connection1, self.rate, self.delay, buffer, track2)}
+        self.links = {connection1: HalfLink(context, linkid, connection1, connection2, self.rate, self.delay, buffer, track1, self),  \
+                      connection2: HalfLink(context, linkid, connection2, connection1, self.rate, self.delay, buffer, track2, self)}
         self.id = linkid
+        self.context = context
 
         # Variables for metric tracking
         # Dropped packets keeps track of the number of packets dropped in the
@@ -47,11 +51,12 @@ class Link:
         self.droppedpackets = 0
         # Track is a boolean value indicating whether we should track this link.
         self.track = (track1 or track2)
-        # Sets up the dictionaries to track all necessary statistics for this
+        # Sets up the series to track all necessary statistics for this
         # link
+        self.series = {}
         if (self.track):
             for m in globals.LINKMETRICS:
-                globals.statistics[linkid+":"+m] = {}
+                self.series[m] = self.context.statistics.add_series(linkid+":"+m)
 
 
     def get_delay(self):
@@ -59,19 +64,13 @@ class Link:
 
 
     def get_effective_rate(self, sender):
+        # The scheduler only brings idle links up to date when something
+        # looks at them, so let it know before we read the rate.
+        if self.context.scheduler is not None:
+            self.context.scheduler.sync_link(self)
         return self.links[sender].get_effective_rate()
 
 
-    def run(self):
-        """This function performs both actions that each link must complete at
-            each time step- updating statistics and sending packets. We update
-            the statistics before sending the packet because if we sent packets
-            first it would seem like the buffer is not being used to capacity
-            although it is."""
-        self.update_link_statistics()
-        self.send_packet()
-
-
     def add_to_buffer(self, packet, sender):
         """This function adds a packet to the buffer on the appropriate side of
            the link if possible, dropping it if there is insufficient space left
@@ -81,13 +80,7 @@ class Link:
                packet : the packet which we are attempting to add to the buffer
                sender : the string ID of the object that is trying to add the
                         packet to the link buffer."""
-        # Added will store the number of bits added to the buffer.
-        added = self.links[sender].add_to_buffer(packet)
-
-        # If added is 0, we added 0 bytes to the link buffer, so the packet was
-        # dropped.
-        if (added == 0):
-            self.droppedpackets = self.droppedpackets + 1
+        self.links[sender].send(packet)
 
 
     def send_packet(self):
@@ -97,6 +90,32 @@ class Link:
             link.send_packet()
 
 
+    def fill_idle(self, tick, times):
+        """This function does the work of update_link_statistics and
+           send_packet for each of the timesteps from tick on, whose values
+           of systime are times, all at once, when no packet finishes
+           transmitting or arrives at its destination in any of them. The
+           scheduler uses it to fill in a stretch of timesteps the link was
+           idle for without going through them one at a time."""
+        if self.track:
+            # Any drop is recorded in the first timestep
+            self.series[globals.PACKETLOSS].record(tick, self.droppedpackets)
+            self.series[globals.PACKETLOSS].record_range(tick + 1, \
+                                                         len(times) - 1, 0)
+            self.droppedpackets = 0
+        # The same elapsed time update_rate works out, for each timestep
+        elapsed = [(t + globals.dt if t != 0 else 0) for t in times]
+        for link in self.links.values():
+            link.fill_idle(tick, elapsed)
+
+
+    def is_empty(self):
+        """This function returns whether the link has nothing to do: no
+           packets in either HalfLink and no drop left to record."""
+        return self.droppedpackets == 0 and \
+               all(link.is_empty() for link in self.links.values())
+
+
     def update_link_statistics(self):
         """This function will update the link statistics for both HalfLinks
            associated with the link, as well as updating the packetloss for
@@ -104,18 +123,19 @@ class Link:
         for link in self.links.values():
             link.update_link_statistics()
         if self.track:
-            key = self.id + ":" + globals.PACKETLOSS
-            globals.statistics[key][globals.systime] = self.droppedpackets
+            self.series[globals.PACKETLOSS].record(self.context.tick, \
+                                                   self.droppedpackets)
             self.droppedpackets = 0
 
 
 
 class HalfLink:
-    def __init__(self, id, source, destination, rate, delay, buffersize, track=True):
+    def __init__(self, context, id, source, destination, rate, delay, buffersize, track=True, link=None):
         """This function initializes new half-link objects, where a half-link
            object represents one direction of the link, so all packets that
            travel across a half-link go the same destination along the link.
            INPUT ARGUMENTS-
+               context : The SimulationContext of the run the link is part of
                linkid : The string ID of the link being constructed
                source : The string ID of the object that will be sending packets
                         along this half link
@@ -126,8 +146,11 @@ class HalfLink:
                buffersize : The size of the buffer for this link in bits.
                track : A boolean value specifying whether or not the half link
                        should have its metrics tracked
+               link : The Link this half-link is one direction of
            FIELDS-
+               context : The SimulationContext of the run the link is part of
                id : The string ID of the link
+               link : The Link this half-link is one direction of
                rate : The maximum link rate of the link (in bps)
                delay : The propagation delay of the link (in s)
                buffercapacity : The total capacity of the link's buffer (in bits)
@@ -138,6 +161,8 @@ class HalfLink:
                         this link
                destination : The string ID of the object which recieves things
                              along this link
+               receiver : The object which recieves things along this link
+                          (set by Simulator.compile_topology)
                next_packet_send_time : The time that we should send (or try to
                                        send) the next packet. If the buffer is
                                        nonempty, this will be the time that
@@ -149,14 +174,14 @@ class HalfLink:
                                       packets in packets_in_transmission should
                                       arrive at their destination
                track : A boolean value indicating if this link is being tracked.
-               lrwindow : The size of the window (in seconds) over which we are
-                          computing link rate for the link rate statistics
-               lrsteps : A list of the number of bits which were sent along the
-                         link in various timesteps (where the first item represents
-                         the earliest time step and the last represents the most
-                         recent)"""
+               linkrate : A RateWindow estimating the link rate from the
+                          number of bits sent along the link in each timestep,
+                          over the last context.linkratewindow seconds"""
+        self.context = context
         # stores the string ID of the link this half-link corresponds to
         self.id = id
+        # stores the Link this half-link is one direction of
+        self.link = link
         # stores the maximum link rate of this half-link in bps
         self.rate = rate
         # stores the propagation delay in s
@@ -173,11 +198,13 @@ class HalfLink:
         # stores the string ID of the object that recieves packets from this
         # half-link
         self.destination = destination
+        # stores the object that recieves packets from this half-link
+        self.receiver = None
 
         # next_packet_send_time will store the time that we should next send (or
         # try to send) the next packet. The first time we should try to send a
         # packet is at the next time step.
-        self.next_packet_send_time = globals.systime + globals.dt
+        self.next_packet_send_time = self.context.systime + globals.dt
         # stores the packets that are currently in transmission (propegating
         # along the half-link), and their corresponding arrival times
         self.packets_in_transmission = []
@@ -186,19 +213,31 @@ class HalfLink:
         # Variables for metric tracking
         # track indicates whether or not to track metrics for this half-link
         self.track = track
-        # lrwindow stores the window over which we are estimating link rate.
-        self.lrwindow = 5000 * globals.dt
-        # lrsteps stores a list of values corresponding to each time step in
-        # the window, where the value indicates the number of bits transmitted
-        # by the half link during the corresponding time step.
-        self.lrsteps = []
-        # stores the current link rate achieved by this half-link
-        self.effectiverate = 0
-        # If we are tracking this half link, we set up dictionaries for all of
-        # its metrics which we are tracking.
+        # linkrate keeps the number of bits transmitted by the half link in
+        # each time step of the window, and computes the link rate from them
+        # whenever someone asks for it.
+        self.linkrate = RateWindow(context.linkratewindow, context.rateestimator)
+        # If we are tracking this half link, we set up series for all of its
+        # metrics which we are tracking.
+        self.series = {}
         if track:
             for m in globals.HALFLINKMETRICS:
-                globals.statistics[id+":"+source+"->"+destination+":"+m] = {}
+                self.series[m] = self.context.statistics.add_series( \
+                    id+":"+source+"->"+destination+":"+m)
+
+
+    def send(self, packet):
+        """This function adds a packet to this half-link's buffer, dropping it
+           if there is insufficient space left, like Link.add_to_buffer. Routers
+           forward packets straight to the half-link through this."""
+        # The scheduler needs to catch this link up before its buffer
+        # changes, and to know that it has work to do.
+        if self.context.scheduler is not None:
+            self.context.scheduler.wake_link(self.link)
+
+        # If we added 0 bytes to the link buffer, the packet was dropped.
+        if (self.add_to_buffer(packet) == 0):
+            self.link.droppedpackets = self.link.droppedpackets + 1
 
 
     def add_to_buffer(self, packet):
@@ -209,7 +248,7 @@ class HalfLink:
         # (i.e. this packet) as soon as it finishes transmitting (which will take
         # time + sizeofpacket/transmissionrate)
         if (len(self.buffer) == 0):
-            self.next_packet_send_time = globals.systime + (packet.get_size()/self.rate)
+            self.next_packet_send_time = self.context.systime + (packet.get_size()/self.rate)
 
         # Checks that there is room to add the packet to the buffer
         if (packet.get_size() + self.buffersize <= self.buffercapacity):
@@ -236,7 +275,7 @@ class HalfLink:
         bitstransmitted = 0
         # If we are at or have passed the time at which we should send the next
         # packet, we should try to send the next packet.
-        if (self.next_packet_send_time <= globals.systime):
+        if (self.next_packet_send_time <= self.context.systime):
             # If there is nothing currently in the buffer, we have nothing to
             # send at this time.
             if (len(self.buffer) == 0):
@@ -254,7 +293,7 @@ class HalfLink:
                 # Time represents the amount of time in the previous dt that we
                 # were transmitting. (i.e. between the previous systime and the
                 # current)
-                time = self.next_packet_send_time - (globals.systime - globals.dt)
+                time = self.next_packet_send_time - (self.context.systime - globals.dt)
                 # bitstransmitted represents the number of bits that were
                 # transmitted in the previous dt
                 bitstransmitted = time * self.rate
@@ -293,25 +332,7 @@ class HalfLink:
                 pass
 
         # Now, we compute and update the effective rate of the link.
-        rate = 0
-        self.lrsteps.append(bitstransmitted)
-        if(globals.systime <= self.lrwindow):
-            if (globals.systime != 0):
-                rate = sum(self.lrsteps)/(globals.systime + globals.dt)
-            # when the time is 0, we will just set the rate to be 0.
-            else:
-                pass
-        else:
-            self.lrsteps.pop(0)
-            rate = sum(self.lrsteps)/self.lrwindow
-        self.effectiverate = rate
-
-        # If we are tracking this HalfLink, we will also record its current
-        # rate.
-        if (self.track):
-            key = self.id + ":" + self.source + "->" + self.destination + ":" \
-                    + globals.LINKRATE
-            dict = globals.statistics[key][globals.systime] = rate
+        self.update_rate(bitstransmitted)
 
         # Now we will check if any packets should be arriving at their
         # destination.
@@ -321,30 +342,65 @@ class HalfLink:
             # list of packet_arrival_times, as well as the corresponding first
             # element of the list of packets_in_transmission and we should send
             # that packet to its destination.
-            if (self.packet_arrival_times[0] <= globals.systime):
+            if (self.packet_arrival_times[0] <= self.context.systime):
                 packet_to_send = self.packets_in_transmission.pop(0)
                 self.packet_arrival_times.pop(0)
-                dest_type = ''
-                if self.destination[0] == 'H':
-                    dest_type = 'hosts'
-                else:
-                    dest_type = 'routers'
-                receiver = globals.idmapping[dest_type][self.destination]
-                receiver.receive_packet(packet_to_send, self.id)
+                self.receiver.receive_packet(packet_to_send, self.id)
         return amountfreed
 
 
+    def update_rate(self, bitstransmitted):
+        """This function adds the number of bits transmitted in the current
+           timestep to the link rate window, and records the effective rate of
+           the link if we are tracking this HalfLink."""
+        # When the time is 0, we report a rate of 0.
+        elapsed = 0
+        if (self.context.systime != 0):
+            elapsed = self.context.systime + globals.dt
+        self.linkrate.step(elapsed, bitstransmitted)
+
+        # If we are tracking this HalfLink, we will also record its current
+        # rate. Otherwise the rate is only computed when a router asks for it.
+        if (self.track):
+            self.series[globals.LINKRATE].record(self.context.tick, \
+                                                 self.linkrate.rate())
+
+
+    def fill_idle(self, tick, elapsed):
+        """This function does the work of update_link_statistics and
+           send_packet for each of the timesteps from tick on, all at once,
+           when no packet finishes transmitting or arrives at the destination
+           in any of them. elapsed holds the time update_rate works out for
+           each of them. If the buffer is nonempty we were transmitting for
+           the whole of every one of them, otherwise we transmitted nothing."""
+        if (self.track):
+            self.series[globals.BUFFEROCCUPANCY].record_range(tick, \
+                len(elapsed), self.buffersize)
+        if (len(self.buffer) != 0):
+            amount = globals.dt * self.rate
+        else:
+            amount = 0
+        rates = self.linkrate.fill(amount, elapsed)
+        if (self.track):
+            self.series[globals.LINKRATE].record_many(tick, rates)
+
+
+    def is_empty(self):
+        """This function returns whether the HalfLink has no packets waiting
+           to be sent or on their way."""
+        return len(self.buffer) == 0 and len(self.packet_arrival_times) == 0
+
+
     def update_link_statistics(self):
         """This function updates the tracking of bufferoccupancy for this
            HalfLink if we are tracking it."""
         if (self.track):
-            key = self.id + ":" + self.source + "->" + self.destination + ":" \
-                  + globals.BUFFEROCCUPANCY
-            globals.statistics[key][globals.systime] = self.buffersize
+            self.series[globals.BUFFEROCCUPANCY].record(self.context.tick, \
+                                                        self.buffersize)
 
 
     def get_effective_rate(self):
-        return self.effectiverate
+        return self.linkrate.rate()
 
 
     def get_buffer_size(self):
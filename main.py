@@ -1,35 +1,311 @@
 # This is the main script that runs the simulator class and holds all
 # the variables.
 import sys
+import argparse
 import globals
+import metrics
+import results
 import time
 # Supressing warnings about time clock being deprecated for higher versions of Python3
 import warnings
 warnings.filterwarnings("ignore")
 from simulator import Simulator
 
-now = time.clock()
+now = time.perf_counter()
 # Initialize all the global variables
 globals.initialize()
 
+# Replot a run that was saved with --output, without running it again
+if (len(sys.argv) > 1 and sys.argv[1] == "plot"):
+    parser = argparse.ArgumentParser(prog = "main.py plot")
+    parser.add_argument("directory",
+                        help = "results directory written with --output")
+    parser.add_argument("--start", type = float, default = 0,
+                        help = "time (in seconds) to start the plots at")
+    parser.add_argument("--end", type = float,
+                        help = "time (in seconds) to end the plots at "
+                               "(default: the end of the run)")
+    parser.add_argument("--name",
+                        help = "name to give the figures (default: the name "
+                               "of the input file of the run)")
+    parser.add_argument("--plot-workers", type = int,
+                        help = "number of processes to draw the figures in "
+                               "(default: one per CPU)")
+    parser.add_argument("--exact-plots", action = "store_true",
+                        help = "draw every sample, instead of only the "
+                               "lowest and highest at each pixel")
+    args = parser.parse_args(sys.argv[2:])
+    import plotting
+    saved = results.Results(args.directory)
+    start = int(round(args.start / saved.dt))
+    end = None if args.end is None else int(round(args.end / saved.dt))
+    name = args.name
+    if name is None:
+        name = (saved.filename or "results").split(".")[0]
+    plotting.plot_metrics(saved, name, saved.hostflows, start, end, \
+                          args.plot_workers, args.exact_plots)
+    sys.exit()
+
+# Run many scenarios, for every combination of some settings, in parallel
+if (len(sys.argv) > 1 and sys.argv[1] == "sweep"):
+    import sweep
+    parser = argparse.ArgumentParser(prog = "main.py sweep")
+    parser.add_argument("scenarios", nargs = "+", metavar = "FILE[:SECONDS]",
+                        help = "input files to run, each for SECONDS if given "
+                               "(otherwise for --runtime)")
+    parser.add_argument("--runtime", type = float, default = 20,
+                        help = "seconds to run each scenario for by default")
+    parser.add_argument("--set", action = "append", default = [],
+                        metavar = "KIND.ID.FIELD=V1,V2,...",
+                        help = "run with FIELD of the object ID (or every "
+                               "object, with *) in KIND (links, hosts, "
+                               "routers or flows) set to each value, e.g. "
+                               "\"links.L1.rate=5,10\"")
+    parser.add_argument("--buffer-size", metavar = "KB,...",
+                        help = "buffer sizes to give every link")
+    parser.add_argument("--link-rate", metavar = "MBPS,...",
+                        help = "rates to give every link")
+    parser.add_argument("--start-time", action = "append", default = [],
+                        metavar = "FLOW=SECONDS,...",
+                        help = "start times to give the flow FLOW")
+    parser.add_argument("--congestion-control", metavar = "reno,fast",
+                        help = "congestion control to give every flow")
+    parser.add_argument("--workers", type = int,
+                        help = "number of processes to run the jobs in "
+                               "(default: one per CPU)")
+    parser.add_argument("--timeout", type = float,
+                        help = "seconds of wall time after which a job is "
+                               "stopped")
+    parser.add_argument("--summary", metavar = "FILE",
+                        help = "also save the summary table as CSV to FILE")
+    args = parser.parse_args(sys.argv[2:])
+
+    settings = list(args.set)
+    if args.buffer_size is not None:
+        settings.append("links.*.buffersize=" + args.buffer_size)
+    if args.link_rate is not None:
+        settings.append("links.*.rate=" + args.link_rate)
+    for start in args.start_time:
+        settings.append("flows." + start.replace("=", ".start=", 1))
+    if args.congestion_control is not None:
+        settings.append("flows.*.congestion_control=" + \
+                        args.congestion_control)
+    scenarios = []
+    try:
+        grid = [sweep.parse_setting(s) for s in settings]
+        for scenario in args.scenarios:
+            (filename, _, runtime) = scenario.partition(":")
+            scenarios.append((filename, float(runtime) if runtime else \
+                              args.runtime))
+    except ValueError as e:
+        sys.exit(str(e))
+
+    jobs = sweep.make_jobs(scenarios, grid, args.timeout)
+    print("Running", len(jobs), "jobs.")
+    rows = sweep.run_sweep(jobs, args.workers)
+    print(sweep.format_table(rows))
+    if args.summary is not None:
+        sweep.write_csv(rows, args.summary)
+    print("TIME ELAPSED: ")
+    print(time.perf_counter() - now)
+    sys.exit()
+
+# Carry on a run saved with --checkpoint, once for each branch
+if (len(sys.argv) > 1 and sys.argv[1] == "fork"):
+    import sweep
+    from simulator import restore
+    parser = argparse.ArgumentParser(prog = "main.py fork")
+    parser.add_argument("snapshot",
+                        help = "file the run was saved to with --checkpoint")
+    parser.add_argument("--branch", action = "append", default = [],
+                        metavar = "\"SETTING ...\"",
+                        help = "carry the run on with these settings, "
+                               "separated by spaces: flows.ID.start=SECONDS "
+                               "or links.ID.buffersize=KB (ID can be *). "
+                               "A setting with several values separated by "
+                               "commas makes a branch for each of them. "
+                               "(default: one branch with no changes)")
+    parser.add_argument("--workers", type = int,
+                        help = "number of processes to run the branches in "
+                               "(default: one per CPU)")
+    parser.add_argument("--timeout", type = float,
+                        help = "seconds of wall time after which a branch is "
+                               "stopped")
+    parser.add_argument("--summary", metavar = "FILE",
+                        help = "also save the summary table as CSV to FILE")
+    args = parser.parse_args(sys.argv[2:])
+
+    branches = args.branch or [""]
+    try:
+        branches = [[sweep.parse_setting(s) for s in b.split()] \
+                    for b in branches]
+        sim = restore(args.snapshot)
+        runtime = sim.duration * globals.dt
+        jobs = sweep.make_branches(args.snapshot, runtime, branches, \
+                                   args.timeout)
+        # Check every branch can be made before starting any of them
+        sweep.check_branches(sim, jobs)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    print("Running", len(jobs), "branches of", sim.filename, "from",
+          sim.context.systime, "s.")
+    rows = sweep.run_sweep(jobs, args.workers)
+    print(sweep.format_table(rows))
+    if args.summary is not None:
+        sweep.write_csv(rows, args.summary)
+    print("TIME ELAPSED: ")
+    print(time.perf_counter() - now)
+    sys.exit()
+
 # Create the simulator with the given filename
 if (len(sys.argv) < 3):
     sys.exit("Please include the input file and run time as arguments.\n example: \
-        python3 main.py test_case1.json 20")
+        python3 main.py test_case1.json 20\n or replot a saved run with: \
+        python3 main.py plot DIR")
+
+parser = argparse.ArgumentParser()
+parser.add_argument("filename")
+parser.add_argument("runtime")
+parser.add_argument("--link-rate-window", type = float,
+                    default = globals.LINKRATEWINDOW,
+                    help = "seconds over which link rates are estimated")
+parser.add_argument("--flow-rate-window", type = float,
+                    default = globals.FLOWRATEWINDOW,
+                    help = "seconds over which flow rates are estimated")
+parser.add_argument("--rate-estimator", choices = ["window", "ewma"],
+                    default = globals.RATEESTIMATOR,
+                    help = "average rates over a sliding window, or use an "
+                           "exponentially weighted moving average")
+parser.add_argument("--sample-interval", type = float,
+                    help = "seconds between samples of every metric "
+                           "(default: every timestep)")
+parser.add_argument("--sample-metric", action = "append", default = [],
+                    metavar = "METRIC=SECONDS[:AGGREGATE]",
+                    help = "sampling interval and aggregate (last, mean, max "
+                           "or sum) for one metric, e.g. "
+                           "\"buffer occupancy=0.01:max\"")
+parser.add_argument("--output", metavar = "DIR",
+                    help = "stream the metrics to DIR while the simulation "
+                           "runs instead of keeping them in memory")
+parser.add_argument("--output-format", choices = results.FORMATS,
+                    default = results.BIN,
+                    help = "format to write the metrics in with --output")
+parser.add_argument("--plot-workers", type = int,
+                    help = "number of processes to draw the figures in "
+                           "(default: one per CPU)")
+parser.add_argument("--exact-plots", action = "store_true",
+                    help = "draw every sample, instead of only the lowest "
+                           "and highest at each pixel")
+parser.add_argument("--no-plot", action = "store_true",
+                    help = "only run the simulation, without loading "
+                           "matplotlib or drawing any figures (use with "
+                           "--output to keep the results)")
+parser.add_argument("--checkpoint", metavar = "FILE",
+                    help = "save the whole state of the run to FILE at "
+                           "--checkpoint-at, to carry it on from there with "
+                           "\"main.py fork FILE\"")
+parser.add_argument("--checkpoint-at", type = float, metavar = "SECONDS",
+                    help = "time to save the run at with --checkpoint")
+parser.add_argument("--profile", action = "store_true",
+                    help = "time each part of the simulator and count the "
+                           "packet events while it runs, and print the "
+                           "breakdown at the end")
+parser.add_argument("--memprofile", metavar = "FILE",
+                    help = "measure the memory taken by each part of the "
+                           "simulator every --memprofile-interval while it "
+                           "runs, save the samples as CSV to FILE, and print "
+                           "the most each took in any sample at the end. The "
+                           "parts are measured as they are at each sample; "
+                           "only \"traced peak\" (the most memory allocated "
+                           "since the sample before) sees what happens in "
+                           "between")
+parser.add_argument("--memprofile-interval", type = float, default = 1.0,
+                    metavar = "SECONDS",
+                    help = "simulated time between memory samples with "
+                           "--memprofile")
+args = parser.parse_args()
+
+if (args.link_rate_window <= 0):
+    parser.error("--link-rate-window must be more than 0 seconds")
+if (args.flow_rate_window <= 0):
+    parser.error("--flow-rate-window must be more than 0 seconds")
+if ((args.checkpoint is None) != (args.checkpoint_at is None)):
+    sys.exit("Please give both --checkpoint and --checkpoint-at")
+if (args.checkpoint is not None and args.output is not None):
+    sys.exit("Runs streaming their metrics with --output can't be "
+             "checkpointed")
+
+globals.LINKRATEWINDOW = args.link_rate_window
+globals.FLOWRATEWINDOW = args.flow_rate_window
+globals.RATEESTIMATOR = args.rate_estimator
+
+if args.sample_interval is not None:
+    for m in globals.SAMPLEINTERVAL:
+        globals.SAMPLEINTERVAL[m] = args.sample_interval
+for setting in args.sample_metric:
+    try:
+        (metric, value) = setting.split("=")
+        value = value.split(":")
+        if metric not in globals.SAMPLEINTERVAL or len(value) > 2 or \
+           (len(value) == 2 and value[1] not in metrics.AGGREGATES):
+            raise ValueError
+        globals.SAMPLEINTERVAL[metric] = float(value[0])
+        if len(value) == 2:
+            globals.SAMPLEAGGREGATE[metric] = value[1]
+    except ValueError:
+        sys.exit("Please give metric sampling as METRIC=SECONDS[:AGGREGATE], "
+                 "where METRIC is one of " + ", ".join(globals.SAMPLEINTERVAL) +
+                 " and AGGREGATE is one of " + ", ".join(metrics.AGGREGATES))
+
 try:
-   val = int(sys.argv[2])
+   val = int(args.runtime)
 except ValueError:
    sys.exit("Please enter an integer value in seconds for the runtime")
 
-if (val > 100):
-    sys.exit("This runtime seems too large. \n Please enter an integer value in seconds (less than 100) for the runtime.")
+# Without --output every metric is held in memory for the whole run
+if (val > 100 and args.output is None):
+    sys.exit("This runtime seems too large. \n Please enter an integer value in seconds (less than 100) for the runtime, \n or use --output to stream the metrics to disk.")
 
-sim = Simulator(sys.argv[1], val)
-print("Starting simulation for", sys.argv[1], ", running for", sys.argv[2], "seconds.")
-sim.run()
+# The memory profiler has to be started before the simulation is set up, to
+# see the memory that takes
+memprofiler = None
+if args.memprofile is not None:
+    from memprofile import MemoryProfiler
+    memprofiler = MemoryProfiler(args.memprofile_interval)
+sim = Simulator(args.filename, val, args.output, args.output_format)
+run = sim.run
+if memprofiler is not None:
+    # Stop the run every so often to take a sample
+    run = lambda until = None: memprofiler.run(sim, until)
+print("Starting simulation for", args.filename, ", running for", args.runtime, "seconds.")
+profiler = None
+if args.profile:
+    from profiler import Profiler
+    profiler = Profiler()
+    profiler.start()
+if args.checkpoint is not None:
+    run(args.checkpoint_at)
+    # Saving the run isn't part of running it
+    if profiler is not None:
+        profiler.stop()
+    sim.checkpoint(args.checkpoint)
+    print("Saved the run at", args.checkpoint_at, "seconds to", args.checkpoint)
+    if profiler is not None:
+        profiler.start()
+run()
 print("The simulation finished.")
-sim.plot_metrics()
-end = time.clock()
+if profiler is not None:
+    profiler.stop()
+    print(profiler.report(sim.duration * globals.dt))
+if memprofiler is not None:
+    memprofiler.stop()
+    memprofiler.write(args.memprofile)
+    print(memprofiler.report())
+    print("Saved the memory samples to", args.memprofile)
+if not args.no_plot:
+    sim.plot_metrics(args.plot_workers, args.exact_plots)
+end = time.perf_counter()
 elapsed = end - now
 print("TIME ELAPSED: ")
 print(elapsed)
@@ -0,0 +1,179 @@
+# This file measures how much memory a run takes, and what holds it, for
+# --memprofile. The run is stopped every so often to measure the structures
+# that grow with the length of the run or the number of packets in flight,
+# while tracemalloc follows the total memory allocated in between.
+import csv
+import sys
+import tracemalloc
+from collections import deque
+
+import numpy
+
+import globals
+from metrics import Series
+from packet import Packet
+from ratewindow import RateWindow
+from scoreboard import Scoreboard
+
+# The objects whose attributes count towards the memory of whatever holds
+# them. Anything else (like the objects of the network, which the structures
+# below refer to) only counts its own size.
+OWNED = (Packet, Scoreboard, Series, RateWindow)
+
+# The subsystems the memory is put down to
+STATISTICS = "statistics"
+LINKBUFFERS = "link buffers"
+PACKETPOOL = "packet pool"
+SCOREBOARDS = "host scoreboards"
+SENDTIMES = "flow send_times"
+DUPCOUNT = "flow dup_count"
+TRANSMITTED = "flow successfullytransmitted"
+SUBSYSTEMS = [STATISTICS, LINKBUFFERS, PACKETPOOL, SCOREBOARDS, SENDTIMES, \
+              DUPCOUNT, TRANSMITTED]
+
+# The other columns of the time series: everything tracemalloc has seen
+# allocated and not freed when the sample was taken, the most there was at
+# any point since the sample before, and whatever of the first isn't in any
+# of the subsystems
+TRACED = "traced"
+PEAK = "traced peak"
+OTHER = "other"
+COLUMNS = SUBSYSTEMS + [OTHER, TRACED, PEAK]
+
+def size_of(obj, seen):
+    """This function returns the number of bytes taken by obj and everything
+       it holds that hasn't been counted yet (by id, in seen)."""
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    # This counts the data of numpy arrays that own it as well
+    size = sys.getsizeof(obj)
+    if isinstance(obj, numpy.ndarray):
+        # Arrays loaded from a checkpoint keep their data in the buffer they
+        # were read from
+        if not obj.flags.owndata:
+            size += obj.nbytes
+    elif isinstance(obj, dict):
+        for (key, value) in obj.items():
+            size += size_of(key, seen) + size_of(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        for item in obj:
+            size += size_of(item, seen)
+    elif isinstance(obj, OWNED):
+        if hasattr(obj, "__dict__"):
+            size += size_of(obj.__dict__, seen)
+        for name in getattr(type(obj), "__slots__", ()):
+            size += size_of(getattr(obj, name, None), seen)
+    return size
+
+
+def measure(context):
+    """This function returns the number of bytes held by each subsystem of the
+       run in context, as a dictionary of subsystem : bytes."""
+    flows = context.idmapping['flows'].values()
+    halflinks = [h for link in context.idmapping['links'].values() \
+                 for h in link.links.values()]
+    parts = {
+        STATISTICS : [context.statistics.series],
+        LINKBUFFERS : [l for h in halflinks for l in (h.buffer, \
+                       h.packets_in_transmission, h.packet_arrival_times)],
+        PACKETPOOL : [context.packetpool],
+        SCOREBOARDS : [host.flow_packets_seen for host in \
+                       context.idmapping['hosts'].values()],
+        SENDTIMES : [flow.send_times for flow in flows],
+        DUPCOUNT : [flow.dup_count for flow in flows],
+        TRANSMITTED : [flow.successfullytransmitted for flow in flows],
+    }
+    sizes = {}
+    for (subsystem, objects) in parts.items():
+        seen = set()
+        sizes[subsystem] = sum(size_of(obj, seen) for obj in objects)
+    return sizes
+
+
+
+class MemoryProfiler:
+    def __init__(self, interval=1.0):
+        """This function initializes a memory profiler, and starts tracemalloc
+           so that the memory taken while the simulation is set up is counted
+           too (so make it before the Simulator).
+           INPUT ARGUMENTS-
+               interval : How often (in simulated s) to take a sample
+           FIELDS-
+               next : The timestep to take the next sample at
+               samples : A list of (time, {column : bytes}) for every sample,
+                         with the columns in COLUMNS. The subsystems are
+                         measured as they are at the time of the sample;
+                         only PEAK covers the time since the sample before."""
+        self.interval = interval
+        self.samples = []
+        self.next = None
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+
+    def sample(self, sim, tick):
+        """This function measures the memory of the run as it is now, stopped
+           before timestep tick."""
+        # Read the totals before measuring the subsystems allocates anything
+        (traced, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        values = measure(sim.context)
+        values[OTHER] = traced - sum(values.values())
+        values[TRACED] = traced
+        values[PEAK] = peak
+        self.samples.append((round(tick * globals.dt, 9), values))
+
+
+    def run(self, sim, until=None):
+        """This function runs sim like Simulator.run, but stops it every
+           interval seconds to take a sample."""
+        end = sim.duration * globals.dt
+        if until is None or until > end:
+            until = end
+        # Work in timesteps, as systime is summed up one dt at a time and
+        # drifts away from the times we stop at
+        stop = int(round(until / globals.dt))
+        step = max(1, int(round(self.interval / globals.dt)))
+        if not self.samples:
+            self.sample(sim, 0)
+            self.next = step
+        while self.next < stop:
+            sim.run(self.next * globals.dt)
+            self.sample(sim, self.next)
+            self.next += step
+        sim.run(None if stop >= sim.duration else until)
+        if (self.samples[-1][0] != round(stop * globals.dt, 9)):
+            self.sample(sim, stop)
+
+
+    def stop(self):
+        tracemalloc.stop()
+
+
+    def peaks(self):
+        """This function returns the most each column got to in any sample,
+           in bytes."""
+        return {c : max(values[c] for (time, values) in self.samples) \
+                for c in COLUMNS}
+
+
+    def report(self):
+        """This function returns the most memory each subsystem held in any
+           sample as text. Only traced peak covers the time between samples
+           as well."""
+        peaks = self.peaks()
+        lines = ["%-30s %12s" % ("memory", "max sampled (MB)")]
+        for c in COLUMNS:
+            lines.append("%-30s %12.3f" % (c, peaks[c] / 2**20))
+        return "\n".join(lines)
+
+
+    def write(self, filename):
+        """This function saves the samples as CSV, one row per sample with the
+           simulated time and the bytes in each column."""
+        with open(filename, "w", newline = "") as f:
+            writer = csv.writer(f)
+            writer.writerow(["time"] + COLUMNS)
+            for (time, values) in self.samples:
+                writer.writerow([time] + [values[c] for c in COLUMNS])
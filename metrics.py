@@ -0,0 +1,387 @@
+import numpy
+
+# Ways of combining the values recorded within one sampling interval.
+LAST = "last"
+MEAN = "mean"
+MAX = "max"
+SUM = "sum"
+AGGREGATES = [LAST, MEAN, MAX, SUM]
+
+# Number of sampling intervals a series holds in memory at a time when it is
+# being streamed to disk.
+CHUNK = 1 << 16
+
+# Runs of at least this many values are recorded with numpy by record_many()
+BATCH = 16
+
+def bucket_range(period, start, end, buckets):
+    """This function returns the first interval and one past the last interval
+       holding the timesteps from start up to (not including) end, for a series
+       with buckets intervals of period timesteps."""
+    first = 0 if start is None else max(0, start // period)
+    last = buckets if end is None else min(buckets, -(-end // period))
+    return (first, max(first, last))
+
+
+def samples(first, period, values):
+    """This function turns the array of samples for the intervals starting at
+       interval first into the first timestep of each interval with a sample,
+       and those samples."""
+    buckets = numpy.flatnonzero(~numpy.isnan(values))
+    return ((first + buckets) * period, values[buckets])
+
+
+class Series:
+    def __init__(self, length, period=1, aggregate=LAST, writer=None, key=None):
+        """This function initializes a series of samples for a single metric
+           of a single object. The run is split into sampling intervals of
+           period timesteps, and the values recorded within an interval are
+           combined into one sample. Samples are stored in a preallocated
+           float64 array indexed by interval, with NaN for the intervals in
+           which nothing was recorded.
+           INPUT ARGUMENTS-
+               length : The number of timesteps to allocate room for
+               period : The number of timesteps in a sampling interval
+               aggregate : How values within an interval are combined (LAST,
+                           MEAN, MAX or SUM)
+               writer : A ResultWriter to stream the samples to, in which case
+                        we only hold CHUNK intervals in memory at a time
+               key : The key of this series, to give to the writer
+           FIELDS-
+               buckets : The number of intervals in the run
+               values : The array of samples (the current chunk of them if
+                        we are streaming)
+               offset : The interval that values[0] holds
+               bucket : The interval currently being recorded, or -1
+               current : The sample for that interval so far
+               count : The number of values recorded in that interval"""
+        self.period = period
+        self.aggregate = aggregate
+        self.writer = writer
+        self.key = key
+        self.buckets = -(-length // period)
+        if writer is None:
+            self.values = numpy.full(self.buckets, numpy.nan)
+        else:
+            self.values = numpy.full(CHUNK, numpy.nan)
+        self.offset = 0
+        self.bucket = -1
+        self.current = 0
+        self.count = 0
+
+
+    def record(self, tick, value):
+        """This function records value as a sample for timestep tick."""
+        bucket = tick // self.period
+        if (bucket != self.bucket):
+            self.flush()
+            self.bucket = bucket
+            self.current = value
+            self.count = 1
+            return
+
+        self.count = self.count + 1
+        if (self.aggregate == LAST):
+            self.current = value
+        elif (self.aggregate == MAX):
+            if (value > self.current):
+                self.current = value
+        elif (self.aggregate == SUM):
+            self.current = self.current + value
+        else:
+            self.current = self.current + (value - self.current) / self.count
+
+
+    def record_many(self, tick, values):
+        """This function records values[i] as a sample for timestep tick + i,
+           for every i. It is the same as calling record() for each of them,
+           but combines the values a whole sampling interval at a time."""
+        if (len(values) == 0):
+            return
+        if (len(values) < BATCH):
+            # Too few to be worth setting up the arrays for
+            end = tick + len(values) - 1
+            if (tick // self.period == self.bucket and \
+                end // self.period == self.bucket):
+                # They all go in the interval being recorded
+                self.accumulate(values)
+            elif (self.period == 1 and self.writer is None and \
+                  tick > self.bucket and end < len(self.values)):
+                # Every timestep is its own interval, so they can all be
+                # written straight to the array but the last, which is left
+                # being recorded as record() would leave it
+                self.flush()
+                self.values[tick:end] = values[:-1]
+                (self.bucket, self.current, self.count) = (end, values[-1], 1)
+            else:
+                for value in values:
+                    self.record(tick, value)
+                    tick = tick + 1
+            return
+        values = numpy.asarray(values, dtype = float)
+        period = self.period
+        bucket = tick // period
+        if (bucket != self.bucket):
+            self.flush()
+            self.bucket = bucket
+            self.count = 0
+        # The values in the interval being recorded
+        first = min(len(values), period - tick % period)
+        self.merge(values[:first])
+        values = values[first:]
+        if (len(values) == 0):
+            return
+
+        # The values in the intervals after it, whole intervals first. The
+        # last interval is left being recorded, as record() would leave it.
+        whole = len(values) // period
+        samples = self.combine(values[:whole * period].reshape(whole, period))
+        rest = values[whole * period:]
+        self.flush()
+        if (len(rest) == 0):
+            self.store(bucket + 1, samples[:-1])
+            (self.bucket, self.current, self.count) = \
+                (bucket + whole, float(samples[-1]), period)
+        else:
+            self.store(bucket + 1, samples)
+            (self.bucket, self.count) = (bucket + whole + 1, 0)
+            self.merge(rest)
+
+
+    def record_range(self, tick, count, value):
+        """This function records value as a sample for each of the count
+           timesteps from tick on."""
+        if (count <= 0):
+            return
+        end = tick + count - 1
+        if (self.period == 1 and self.writer is None and tick > self.bucket \
+            and end < len(self.values)):
+            # As in record_many(), but without making the list of values
+            self.flush()
+            self.values[tick:end] = value
+            (self.bucket, self.current, self.count) = (end, value, 1)
+        elif (count < BATCH):
+            self.record_many(tick, [value] * count)
+        else:
+            self.record_many(tick, numpy.full(count, float(value)))
+
+
+    def accumulate(self, values):
+        """This function adds values to the interval being recorded one at a
+           time, exactly as record() would."""
+        if (self.aggregate == LAST):
+            self.current = values[-1]
+            self.count = self.count + len(values)
+        elif (self.aggregate == MAX):
+            self.count = self.count + len(values)
+            for value in values:
+                if (value > self.current):
+                    self.current = value
+        elif (self.aggregate == SUM):
+            self.count = self.count + len(values)
+            for value in values:
+                self.current = self.current + value
+        else:
+            for value in values:
+                self.count = self.count + 1
+                self.current = self.current + (value - self.current) / \
+                               self.count
+
+
+    def combine(self, values):
+        """This function combines each row of values into one sample."""
+        if (self.aggregate == LAST):
+            return values[:, -1]
+        elif (self.aggregate == MAX):
+            return values.max(axis = 1)
+        elif (self.aggregate == SUM):
+            return values.sum(axis = 1)
+        return values.mean(axis = 1)
+
+
+    def merge(self, values):
+        """This function adds values to the interval being recorded."""
+        sample = float(self.combine(values.reshape(1, len(values)))[0])
+        if (self.count == 0 or self.aggregate == LAST):
+            self.current = sample
+        elif (self.aggregate == MAX):
+            if (sample > self.current):
+                self.current = sample
+        elif (self.aggregate == SUM):
+            self.current = self.current + sample
+        else:
+            self.current = self.current + (sample - self.current) * \
+                           len(values) / (self.count + len(values))
+        self.count = self.count + len(values)
+
+
+    def store(self, bucket, samples):
+        """This function writes samples to the array of samples, for the
+           intervals from bucket on, like flush() does for one interval."""
+        while (len(samples) > 0):
+            index = bucket - self.offset
+            if (index >= len(self.values)):
+                if (self.writer is None):
+                    grown = numpy.full(max(index + len(samples), \
+                                           2 * len(self.values)), numpy.nan)
+                    grown[:len(self.values)] = self.values
+                    self.values = grown
+                    self.buckets = max(self.buckets, index + len(samples))
+                else:
+                    self.emit(self.values)
+                    self.values = numpy.full(CHUNK, numpy.nan)
+                    self.offset = bucket - bucket % CHUNK
+                    index = bucket - self.offset
+            count = min(len(samples), len(self.values) - index)
+            self.values[index:index + count] = samples[:count]
+            samples = samples[count:]
+            bucket = bucket + count
+
+
+    def flush(self):
+        """This function writes the interval currently being recorded to the
+           array of samples."""
+        if (self.bucket < 0):
+            return
+        index = self.bucket - self.offset
+        if (index >= len(self.values)):
+            if (self.writer is None):
+                # We ran for longer than we allocated for, so make room.
+                grown = numpy.full(max(index + 1, 2 * len(self.values)), \
+                                   numpy.nan)
+                grown[:len(self.values)] = self.values
+                self.values = grown
+                self.buckets = max(self.buckets, index + 1)
+            else:
+                # Hand the finished chunk to the writer and start a new one.
+                self.emit(self.values)
+                self.values = numpy.full(CHUNK, numpy.nan)
+                self.offset = self.bucket - self.bucket % CHUNK
+                index = self.bucket - self.offset
+        self.values[index] = self.current
+
+
+    def emit(self, values):
+        """This function passes values, starting at interval offset, to the
+           writer unless nothing was recorded in them."""
+        if not numpy.isnan(values).all():
+            self.writer.write(self.key, self.offset, values)
+
+
+    def close(self):
+        """This function writes out whatever hasn't been written yet, once
+           the run is over."""
+        self.flush()
+        self.bucket = -1
+        if (self.writer is not None):
+            self.emit(self.values[:max(0, self.buckets - self.offset)])
+            self.values = numpy.full(0, numpy.nan)
+
+
+    def array(self):
+        """This function returns the array of samples, one per interval. If
+           the series is being streamed, only the chunk that hasn't been
+           written yet is still here."""
+        self.flush()
+        return self.values
+
+
+    def values_between(self, start=0, end=None):
+        """This function returns the index of the first interval holding any
+           of the timesteps from start up to (not including) end, and the
+           array of samples for the intervals holding them."""
+        (first, last) = bucket_range(self.period, start, end, self.buckets)
+        return (first, self.array()[first:last])
+
+
+    def samples(self, start=0, end=None):
+        """This function returns the first timestep of each interval from
+           start to end in which a sample was recorded and the corresponding
+           samples, as two arrays."""
+        (first, values) = self.values_between(start, end)
+        return samples(first, self.period, values)
+
+
+
+class MetricStore:
+    def __init__(self, length=0, sampling=None, writer=None, dt=None):
+        """This function initializes the store holding every metric series
+           recorded during a run, keyed by "<object id>:<metric>" as before.
+           INPUT ARGUMENTS-
+               length : The number of timesteps in the run
+               sampling : A dictionary of metric : (period, aggregate) giving
+                          the sampling interval (in timesteps) and aggregate
+                          to use for that metric. Metrics that aren't listed
+                          are sampled every timestep.
+               writer : A ResultWriter to stream every series to, if any
+               dt : The length of a timestep (in s)
+           FIELDS-
+               length : The number of timesteps each series is allocated for
+               sampling : The sampling settings for each metric
+               series : A dictionary of key : Series"""
+        self.length = length
+        self.sampling = sampling if sampling is not None else {}
+        self.writer = writer
+        self.dt = dt
+        self.series = {}
+
+
+    def add_series(self, key, period=None, aggregate=None):
+        """This function creates the series for key and returns it, so that
+           the object recording it doesn't need to look it up every timestep.
+           The sampling interval and aggregate come from the settings for the
+           metric at the end of key unless they are given."""
+        (default_period, default_aggregate) = \
+            self.sampling.get(key.split(":")[-1], (1, LAST))
+        if period is None:
+            period = default_period
+        if aggregate is None:
+            aggregate = default_aggregate
+        if self.writer is not None:
+            self.writer.add_series(key, period, aggregate)
+        series = Series(self.length, period, aggregate, self.writer, key)
+        self.series[key] = series
+        return series
+
+
+    def close(self):
+        """This function finishes every series and, if we are streaming,
+           waits for the writer to write everything out."""
+        for series in self.series.values():
+            series.close()
+        if self.writer is not None:
+            self.writer.close()
+
+
+    def keys(self):
+        return self.series.keys()
+
+
+    def __contains__(self, key):
+        return key in self.series
+
+
+    def __getitem__(self, key):
+        return self.series[key]
+
+
+    def period(self, key):
+        """This function returns the sampling interval of key, in timesteps."""
+        return self.series[key].period
+
+
+    def values(self, key, start=0, end=None):
+        """This function returns the first interval and the samples (NaN where
+           nothing was recorded) for key, for timesteps start to end."""
+        return self.series[key].values_between(start, end)
+
+
+    def samples(self, key, start=0, end=None):
+        """This function returns the timesteps and values recorded for key,
+           from timestep start up to (not including) end."""
+        return self.series[key].samples(start, end)
+
+
+    def nbytes(self):
+        """This function returns the number of bytes used by the samples."""
+        return sum(s.values.nbytes for s in self.series.values())
@@ -1,6 +1,14 @@
 import globals
 
+# The most delivered packets each run keeps around to be reused
+POOLSIZE = 1024
+
 class Packet:
+    # Packets don't get a __dict__, which makes them smaller and faster to
+    # create. Every attribute a packet has is listed here.
+    __slots__ = ("sourceid", "flowid", "destinationid", "packetid", "data", \
+                 "packet_type", "size", "ack_flag")
+
     def __init__(self, sourceid, flowid, destinationid, packetid, \
                  packet_type, data = ''):
         """This function initializes a packet object. Input arguments:
@@ -9,28 +17,33 @@ class Packet:
                            with
                 - destinationid : the string ID of the packet's destination
                 - packetid : the number of the packet in its sequence
-                - packet_type : a string idetifying the type of the packet,
-                                (found in globals).
+                - packet_type : an integer code idetifying the type of the
+                                packet, (found in globals).
                     STANDARDPACKET: a normal packet
                     ACKPACKET: an acknowledgement packet
                     ROUTINGPACKET: a routing table packet
                     SYNPACKET: a synchronization packet
                     SYNACK: a synchronization packet acknowledgement
                 - data : the data to be sent in the packet"""
+        self.set(sourceid, flowid, destinationid, packetid, packet_type, data)
+
+    def set(self, sourceid, flowid, destinationid, packetid, packet_type, \
+            data = ''):
+        """This function sets every field of the packet, for a new packet or
+           one being reused from the pool."""
         self.sourceid = sourceid
         self.flowid = flowid
         self.destinationid = destinationid
         self.packetid = packetid
         self.data = data
         self.packet_type = packet_type
-        self.size = 0
 
         # Sets the acknowledgement flag to be true if the packet is either a
         #   normal acknowledgment or a handshake acknoweledgement packet.
         self.ack_flag = (packet_type == globals.ACKPACKET or packet_type == globals.HANDSHAKEACK)
 
         # Set the packet size in bits according to its type.
-        if packet_type == globals.ACKPACKET or packet_type == globals.HANDSHAKEACK:
+        if self.ack_flag:
             self.size = globals.ACKSIZE
         elif packet_type == globals.HANDSHAKEPACKET:
             self.size = globals.HANDSIZE
@@ -69,3 +82,28 @@ class Packet:
 
     def is_routing(self):
         return (self.packet_type == globals.ROUTINGPACKET)
+
+
+def make_packet(context, sourceid, flowid, destinationid, packetid, \
+                packet_type, data = ''):
+    """This function returns a packet with the given fields, reusing one
+       delivered in the run of context if there is one. Takes the same
+       arguments as Packet, after the SimulationContext."""
+    pool = context.packetpool
+    if pool:
+        p = pool.pop()
+        p.set(sourceid, flowid, destinationid, packetid, packet_type, data)
+        return p
+    return Packet(sourceid, flowid, destinationid, packetid, packet_type, data)
+
+
+def release(context, p):
+    """This function hands a packet that has reached its destination back to
+       be reused by the run of context. Only call this once nothing refers to
+       the packet anymore, so not for packets that were sent down several
+       links at once."""
+    pool = context.packetpool
+    if (len(pool) < POOLSIZE):
+        # Don't keep whatever the packet was carrying alive
+        p.data = None
+        pool.append(p)
@@ -0,0 +1,206 @@
+# This file draws the figures for the metrics recorded during a run, either
+# from memory (a MetricStore) or from a results directory (a Results).
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# The figures are only ever saved to files, so never open a window (and
+# never need a display).
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plot
+import numpy
+import globals
+
+def prepare_host_metrics(store, hostflows, start=0, end=None):
+    """This function constructs the host send/recive rates using the recorded
+       flow send/recieve rates.
+       INPUT ARGUMENTS-
+           store : The MetricStore or Results holding the flow rates
+           hostflows : A dictionary of host id : list of the ids of the
+                       tracked flows coming out of that host
+           start, end : The range of timesteps to build the rates for
+       Returns a dictionary of host id : (timesteps, rates)."""
+    rates = {}
+    for (h, flows) in hostflows.items():
+        tracking = False
+        values = None
+        for id in flows:
+            key = id+":"+globals.FLOWRATE
+            (first, newvalues) = store.values(key, start, end)
+            if not tracking:
+                period = store.period(key)
+                values = newvalues.copy()
+                tracking = True
+            else:
+                # Timesteps where only one of the flows has a rate take that
+                # flow's rate.
+                values = numpy.where(numpy.isnan(values), newvalues, \
+                    numpy.where(numpy.isnan(newvalues), values, \
+                                values + newvalues))
+        if tracking:
+            buckets = numpy.flatnonzero(~numpy.isnan(values))
+            rates[h] = ((first + buckets) * period, values[buckets])
+    return rates
+
+
+# The size of every figure (in inches), and its resolution when saved
+FIGSIZE = (12, 4.5)
+DPI = 100
+
+def decimate(times, values, xlim, width):
+    """This function thins a series out to what can actually be seen in a
+       figure width pixels wide. The x range is split into one bucket per
+       pixel, and in each bucket we only keep the first, lowest, highest and
+       last points, so every drop and spike is still drawn exactly as it
+       would have been with all the points.
+       INPUT ARGUMENTS-
+           times, values : The series, sorted by time
+           xlim : The range of the x axis (in s)
+           width : The number of pixels across the x axis
+       Returns the times and values that are kept, which are all of them if
+       the x range is empty (a run that ends where it starts)."""
+    (lo, hi) = xlim
+    if (len(times) <= 4 * width or hi <= lo):
+        return (times, values)
+    buckets = numpy.clip(((times - lo) * (width / (hi - lo))).astype(int), \
+                         0, width - 1)
+    # The points of each bucket, ordered by value
+    order = numpy.lexsort((values, buckets))
+    sortedbuckets = buckets[order]
+    firsts = numpy.flatnonzero(numpy.r_[True, sortedbuckets[1:] != \
+                                              sortedbuckets[:-1]])
+    lasts = numpy.r_[firsts[1:], len(order)] - 1
+    # Times are already sorted, so the first and last points of each bucket
+    # are where the bucket changes.
+    edges = numpy.flatnonzero(buckets[1:] != buckets[:-1])
+    keep = numpy.unique(numpy.concatenate((order[firsts], order[lasts], \
+        edges, edges + 1, [0, len(times) - 1])))
+    return (times[keep], values[keep])
+
+
+def figure_jobs(store, name, hostflows, start, end, exact=False):
+    """This function gathers everything needed to draw each metric's figure,
+       so that the figures can be drawn without the store or the globals.
+       Each series is read into arrays once, in one pass over the keys, and
+       thinned out to the width of the figure unless exact is set.
+       Returns a list of dictionaries, one per figure, holding:
+           metric : The metric being plotted
+           filename : The file to save the figure as
+           xlim : The range of the x axis (in s)
+           ylabel : The label of the y axis
+           presentation : Whether to draw it for a presentation
+           series : A list of (label, times, values) for each line"""
+    # Access all metrics
+    all_metrics = globals.LINKMETRICS + globals.HALFLINKMETRICS + \
+                  globals.FLOWMETRICS + [globals.HOSTFLOWRATE]
+    # How to scale each metric for plotting, and the label for its y axis
+    scales = {
+        # Converts the buffer occupancy from bits to Kilobytes
+        globals.BUFFEROCCUPANCY : (globals.BITSTOKILOBITS/8,
+                                   "buffer occupancy (in KB)"),
+        globals.LINKRATE : (globals.BITSTOMEGABITS, "link rate (in Mbps)"),
+        globals.PACKETLOSS : (1, "number of packets dropped"),
+        # converts flow rate from bps to Mbps
+        globals.FLOWRATE : (globals.BITSTOMEGABITS, "flow rate (in Mbps)"),
+        globals.WINDOWSIZE : (1, "window size"),
+        globals.FLOWRTT : (1, "round trip time (in seconds)"),
+        globals.HOSTFLOWRATE : (globals.BITSTOMEGABITS, "flow rate (in Mbps)"),
+    }
+
+    # Gather the series for each metric
+    series = {t : [] for t in all_metrics}
+    for (h, samples) in prepare_host_metrics(store, hostflows, start, \
+                                             end).items():
+        series[globals.HOSTFLOWRATE].append((h, samples))
+    for s in store.keys():
+        label = s.split(":")
+        metric = label.pop()
+        if metric in series:
+            series[metric].append((":".join(label), \
+                                   store.samples(s, start, end)))
+
+    xlim = (start*store.dt, end*store.dt)
+    # Roughly the number of pixels across the axes
+    width = int(FIGSIZE[0] * DPI)
+    jobs = []
+    for t in all_metrics:
+        (scale, ylabel) = scales[t]
+        lines = []
+        for (label, (ticks, values)) in series[t]:
+            (times, values) = (ticks * store.dt, values * scale)
+            if not exact:
+                (times, values) = decimate(times, values, xlim, width)
+            lines.append((label, times, values))
+        jobs.append({
+            "metric" : t,
+            "filename" : name + " " + t,
+            "xlim" : xlim,
+            "ylabel" : ylabel,
+            "presentation" : globals.PRESENTATIONMODE,
+            "series" : lines,
+        })
+    return jobs
+
+
+def render_figure(job):
+    """This function draws and saves a single figure from figure_jobs. It
+       only uses what is in job, so it can run in another process."""
+    if job["presentation"]:
+        plot.rcParams.update({'font.size' : 12})
+    figure = plot.figure(figsize = FIGSIZE, dpi = DPI)
+    plot.xlim(*job["xlim"])
+    #plot.ylim(ymin = 0)
+    legend = []
+    for (label, times, values) in job["series"]:
+        lines = plot.plot(times, values)
+        plot.ylabel(job["ylabel"])
+        legend.append(label)
+
+        if job["presentation"]:
+            plot.setp(lines, linewidth = 1)
+        else:
+            plot.setp(lines, linewidth = 0.5)
+        plot.xlabel("time (in seconds)")
+
+    plot.title(job["metric"])
+    plot.legend(legend)
+    #if job["presentation"]:
+        #plotname = plotname + " presentation"
+
+    plot.savefig(job["filename"], bbox_inches = "tight")
+    plot.close(figure)
+    return job["filename"]
+
+
+def plot_metrics(store, name, hostflows, start=0, end=None, workers=None, \
+                 exact=False):
+    """This function plots every metric in store, and saves the figures as
+       "<name> <metric>.png". The figures are drawn in parallel.
+       INPUT ARGUMENTS-
+           store : The MetricStore or Results holding the metrics
+           name : The name to give the figures (usually the input file name
+                  without its extension)
+           hostflows : The flows coming out of each host, as given to
+                       prepare_host_metrics
+           start, end : The range of timesteps to plot (by default, the whole
+                        run)
+           workers : The number of processes to draw the figures in (by
+                     default, one per CPU). With 1 they are drawn in this
+                     process.
+           exact : Whether to draw every point, rather than only the ones
+                   that make a difference at the size of the figure"""
+    if end is None:
+        end = store.length
+    jobs = figure_jobs(store, name, hostflows, start, end, exact)
+    for job in jobs:
+        print("Plotting ", job["metric"])
+    if workers is None:
+        workers = os.cpu_count() or 1
+    # Starting processes isn't worth it if they can't run at the same time
+    if (min(workers, len(jobs)) <= 1):
+        for job in jobs:
+            render_figure(job)
+        return
+    with ProcessPoolExecutor(max_workers = min(workers, len(jobs))) as pool:
+        # list() so that any error drawing a figure is raised here
+        list(pool.map(render_figure, jobs))
@@ -0,0 +1,233 @@
+# This file measures where the wall time of a run goes, for --profile. While
+# a Profiler is started, the methods listed in COMPONENTS are replaced with
+# versions that time every call, and put back when it is stopped, so nothing
+# is timed (or slowed down at all) unless a run is being profiled.
+import time
+
+import globals
+from flow_fast import Flow_FAST
+from flow_reno import Flow
+from host import Host
+from link import HalfLink, Link
+from metrics import Series
+from router import Router
+from scheduler import TickScheduler
+
+# Phases of a timestep. Time spent in the scheduler itself, outside of any of
+# the methods below, goes under SCHEDULING.
+LINKS = "links"
+ROUTING = "routing"
+FLOWS = "flows"
+IDLE = "idle fill"
+SCHEDULING = "scheduling"
+PHASES = [LINKS, ROUTING, FLOWS, IDLE, SCHEDULING]
+
+# The methods that are timed: (class, method, phase). A method with a phase
+# starts that phase, and everything called from it is counted under it, so
+# the phases are those of the top of the tick loop. The others are counted
+# under the phase they are called in.
+COMPONENTS = [
+    (TickScheduler, "run_link", LINKS),
+    (TickScheduler, "fill_link", IDLE),
+    (TickScheduler, "fill_flows", IDLE),
+    (Link, "update_link_statistics", None),
+    (HalfLink, "send", None),
+    (HalfLink, "send_packet", None),
+    (Host, "receive_packet", None),
+    (Router, "receive_packet", None),
+    (Router, "recalc_link_state", ROUTING),
+    (Router, "update_routes", None),
+    (Router, "run_dijkstra", None),
+    (Flow, "run", FLOWS),
+    (Flow, "process_ack", None),
+    (Flow, "update_flow_statistics", FLOWS),
+    (Flow_FAST, "run", FLOWS),
+    (Flow_FAST, "process_ack", None),
+    (Flow_FAST, "update_flow_statistics", FLOWS),
+    (Series, "record", None),
+]
+
+# The events that are counted
+ENQUEUED = "packets enqueued"
+DROPPED = "packets dropped"
+DELIVERED = "packets delivered to hosts"
+ACKS = "ACKs delivered"
+ROUTINGPACKETS = "routing packets received"
+EVENTS = [ENQUEUED, DROPPED, DELIVERED, ACKS, ROUTINGPACKETS]
+
+
+class Profiler:
+    def __init__(self):
+        """This function initializes a profiler, which accumulates the wall
+           time and number of calls of each method in COMPONENTS, the wall
+           time of each phase of the timesteps, and counts of the packet
+           events, from when it is started until it is stopped. It times the
+           methods of the classes themselves, so it covers every simulation
+           run in this process while it is started.
+           FIELDS-
+               calls : A dictionary of "Class.method" : [number of calls,
+                       total time, own time], where the own time leaves out
+                       the time spent in the other timed methods it called
+               phases : A dictionary of phase : own time of everything run
+                        in that phase
+               events : A dictionary of event : number of times it happened
+               wall : The wall time (in s) the profiler has been started for
+               phase : The phase currently being run
+               nested : The time spent in timed methods called by each timed
+                        method that is currently running
+               originals : The methods that have been replaced, to put them
+                           back when the profiler is stopped
+               started : The wall time it was last started at, or None if it
+                         is stopped"""
+        self.calls = {}
+        self.phases = {p : 0.0 for p in PHASES}
+        self.events = {e : 0 for e in EVENTS}
+        self.wall = 0.0
+        self.phase = SCHEDULING
+        self.nested = []
+        self.originals = []
+        self.started = None
+
+
+    def timed(self, cls, name, phase):
+        """This function returns a version of cls.name that is timed."""
+        method = cls.__dict__[name]
+        label = cls.__name__ + "." + name
+        entry = self.calls.setdefault(label, [0, 0.0, 0.0])
+        profiler = self
+        count = COUNTERS.get((cls, name))
+        def timed_method(*args):
+            outer = profiler.phase
+            # Filling in idle timesteps is always counted as such, but the
+            # other phases only start from the tick loop itself
+            if (phase is not None and (outer == SCHEDULING or phase == IDLE)):
+                profiler.phase = phase
+            profiler.nested.append(0.0)
+            start = time.perf_counter()
+            try:
+                if count is None:
+                    return method(*args)
+                return count(profiler.events, method, args)
+            finally:
+                # Even if it raised, so that the methods it was called from
+                # are still timed right
+                elapsed = time.perf_counter() - start
+                # Take the time of the timed methods it called out of its own
+                # time
+                own = elapsed - profiler.nested.pop()
+                if profiler.nested:
+                    profiler.nested[-1] += elapsed
+                entry[0] += 1
+                entry[1] += elapsed
+                entry[2] += own
+                profiler.phases[profiler.phase] += own
+                profiler.phase = outer
+        return timed_method
+
+
+    def start(self):
+        """This function starts timing the methods in COMPONENTS."""
+        for (cls, name, phase) in COMPONENTS:
+            self.originals.append((cls, name, cls.__dict__[name]))
+            setattr(cls, name, self.timed(cls, name, phase))
+        self.started = time.perf_counter()
+
+
+    def stop(self):
+        """This function puts the original methods back. The scheduling phase
+           gets whatever time wasn't spent in any of the timed methods."""
+        elapsed = time.perf_counter() - self.started
+        for (cls, name, method) in reversed(self.originals):
+            setattr(cls, name, method)
+        self.originals = []
+        self.started = None
+        self.wall += elapsed
+        self.phases[SCHEDULING] = 0.0
+        self.phases[SCHEDULING] = self.wall - sum(self.phases.values())
+
+
+    def report(self, simulated):
+        """This function returns the breakdown of the time as a text table,
+           given the number of seconds that were simulated."""
+        wall = self.wall
+        lines = ["Profile of %.3f s of wall time for %.3f simulated seconds "
+                 "(%.4f simulated s per wall s)" % (wall, simulated, \
+                 simulated / wall if wall > 0 else 0)]
+
+        lines.append("")
+        lines.append("%-12s %10s %7s" % ("phase", "time (s)", "%"))
+        for p in PHASES:
+            lines.append("%-12s %10.3f %6.1f%%" % (p, self.phases[p], \
+                         100 * self.phases[p] / wall if wall > 0 else 0))
+
+        # Sum up the methods of each class, busiest class first
+        classes = {}
+        for (label, (calls, total, own)) in self.calls.items():
+            if (calls == 0):
+                continue
+            classes.setdefault(label.split(".")[0], []).append( \
+                (label, calls, total, own))
+        order = sorted(classes, key = lambda c: \
+                       -sum(m[3] for m in classes[c]))
+        lines.append("")
+        lines.append("%-36s %12s %10s %10s %7s %10s" % ("component", "calls", \
+                     "total (s)", "own (s)", "own %", "us/call"))
+        for c in order:
+            lines.append("%-36s %12d %10s %10.3f %6.1f%%" % (c, \
+                         sum(m[1] for m in classes[c]), "", \
+                         sum(m[3] for m in classes[c]), \
+                         100 * sum(m[3] for m in classes[c]) / wall \
+                         if wall > 0 else 0))
+            for (label, calls, total, own) in sorted(classes[c], \
+                                                     key = lambda m: -m[3]):
+                lines.append("  %-34s %12d %10.3f %10.3f %6.1f%% %10.2f" % \
+                             (label, calls, total, own, 100 * own / wall \
+                              if wall > 0 else 0, 1e6 * total / calls))
+
+        lines.append("")
+        lines.append("%-28s %12s %14s" % ("event", "count", "per wall s"))
+        for e in EVENTS:
+            lines.append("%-28s %12d %14.1f" % (e, self.events[e], \
+                         self.events[e] / wall if wall > 0 else 0))
+        return "\n".join(lines)
+
+
+
+def count_send(events, method, args):
+    # HalfLink.send doesn't say whether the packet fit, but it counts the
+    # packet on its link if it was dropped
+    link = args[0].link
+    dropped = link.droppedpackets
+    result = method(*args)
+    if (link.droppedpackets > dropped):
+        events[DROPPED] += 1
+    else:
+        events[ENQUEUED] += 1
+    return result
+
+
+def count_delivery(events, method, args):
+    # Hosts are where packets end up, so only count them here rather than at
+    # every router on the way. Look at the packet before it is handed back to
+    # be reused.
+    packet_type = args[1].packet_type
+    events[DELIVERED] += 1
+    if (packet_type == globals.ACKPACKET):
+        events[ACKS] += 1
+    return method(*args)
+
+
+def count_routing(events, method, args):
+    # Routing packets only go between neighbouring routers, so every one a
+    # router receives is counted
+    if (args[1].packet_type == globals.ROUTINGPACKET):
+        events[ROUTINGPACKETS] += 1
+    return method(*args)
+
+
+# The methods that count events, which call the method themselves
+COUNTERS = {
+    (HalfLink, "send") : count_send,
+    (Host, "receive_packet") : count_delivery,
+    (Router, "receive_packet") : count_routing,
+}
@@ -0,0 +1,185 @@
+import numpy
+
+import globals
+
+# Estimator modes.
+WINDOW = "window"
+EWMA = "ewma"
+
+# Runs of at least this many steps are worked out with numpy by fill()
+BATCH = 16
+
+class RateWindow:
+    def __init__(self, window, mode=WINDOW):
+        """This function initializes a rate estimator, which computes a rate
+           from the amount of data (in bits) sent or received in each time step.
+           INPUT ARGUMENTS-
+               window : The length of the window (in seconds) the rate is
+                        averaged over. In EWMA mode, this is the time constant
+                        of the moving average.
+               mode : WINDOW to average over the last window seconds, or EWMA
+                      to use an exponentially weighted moving average.
+           FIELDS-
+               size : The number of time steps in the window
+               steps : A ring buffer holding the amount for each of the last
+                       size time steps
+               index : The position in steps that the next time step goes in
+               count : The number of time steps recorded so far, up to size
+               total : The running sum of the values in steps
+               pending : The amount added so far in the current time step
+               elapsed : The time the rate was being measured for as of the
+                         latest time step (used until the window is full)
+               alpha : The weight given to each new time step (EWMA mode)
+               average, weight : The moving average and the total weight of
+                                 the time steps that went into it (EWMA mode)"""
+        self.window = window
+        self.mode = mode
+        self.size = max(1, int(round(window / globals.dt)))
+        self.steps = [0] * self.size
+        self.index = 0
+        self.count = 0
+        self.total = 0
+        self.pending = 0
+        self.elapsed = 0
+        self.alpha = None
+        if (mode == EWMA):
+            self.alpha = min(1, globals.dt / window)
+        self.average = 0
+        self.weight = 0
+
+
+    def add(self, amount):
+        """This function adds amount bits to the current time step."""
+        self.pending = self.pending + amount
+
+
+    def step(self, elapsed, amount=0):
+        """This function closes the current time step, which had amount bits
+           in it on top of anything passed to add(). elapsed is the amount of
+           time the rate has been measured for, up to the end of the step."""
+        amount = amount + self.pending
+        self.pending = 0
+        self.elapsed = elapsed
+
+        if (self.mode == EWMA):
+            self.average = self.average + self.alpha * \
+                           (amount / globals.dt - self.average)
+            self.weight = self.weight + self.alpha * (1 - self.weight)
+            return
+
+        self.total = self.total + amount - self.steps[self.index]
+        self.steps[self.index] = amount
+        self.index = self.index + 1
+        # Every time we wrap around we recompute the sum from scratch, so that
+        # rounding errors in the running sum can't build up.
+        if (self.index == self.size):
+            self.index = 0
+            self.total = sum(self.steps)
+        if (self.count < self.size):
+            self.count = self.count + 1
+
+
+    def fill(self, amount, elapsed):
+        """This function closes len(elapsed) time steps in a row, each of which
+           had amount bits in it (the first on top of anything passed to
+           add()), where elapsed[i] is the elapsed time as of the end of step
+           i. It is the same as calling step() and then rate() for each step,
+           but long runs of steps are worked out all at once.
+           Returns the rate after each step (as a list or an array)."""
+        n = len(elapsed)
+        if (n < BATCH and self.mode == WINDOW):
+            # Too few steps to be worth setting up the arrays for, so do what
+            # step() and rate() do, without going through them every step
+            rates = []
+            steps = self.steps
+            (index, count, total) = (self.index, self.count, self.total)
+            current = amount + self.pending
+            for e in elapsed:
+                total = total + current - steps[index]
+                steps[index] = current
+                index = index + 1
+                if (index == self.size):
+                    index = 0
+                    total = sum(steps)
+                if (count < self.size):
+                    count = count + 1
+                if (e <= 0):
+                    rates.append(0)
+                elif (count < self.size):
+                    rates.append(total / e)
+                else:
+                    rates.append(total / self.window)
+                current = amount
+            (self.index, self.count, self.total) = (index, count, total)
+            self.pending = 0
+            if (n > 0):
+                self.elapsed = elapsed[-1]
+            return rates
+        if (n < BATCH):
+            rates = []
+            for e in elapsed:
+                self.step(e, amount)
+                rates.append(self.rate())
+            return rates
+        rates = numpy.empty(n)
+        if (self.pending != 0):
+            self.step(elapsed[0], amount)
+            rates[0] = self.rate()
+            rates[1:] = self.fill(amount, elapsed[1:])
+            return rates
+        elapsed = numpy.asarray(elapsed, dtype = float)
+        steps = numpy.arange(1, n + 1)
+
+        if (self.mode == EWMA):
+            # Each step moves the average the same fraction of the way
+            # towards amount / dt, and the weight towards 1
+            decay = (1 - self.alpha) ** steps
+            averages = amount / globals.dt + \
+                       (self.average - amount / globals.dt) * decay
+            weights = 1 - (1 - self.weight) * decay
+            numpy.divide(averages, weights, out = rates, where = weights != 0)
+            rates[weights == 0] = 0
+            self.average = float(averages[-1])
+            self.weight = float(weights[-1])
+            self.elapsed = float(elapsed[-1])
+            return rates
+
+        # The steps in the window, oldest first, followed by the new ones. The
+        # i-th new step pushes the i-th of these out of the window.
+        window = numpy.concatenate((numpy.array(self.steps[self.index:] + \
+                                                self.steps[:self.index], \
+                                                dtype = float), \
+                                    numpy.full(n, float(amount))))
+        totals = self.total + numpy.cumsum(window[self.size:] - window[:n])
+        counts = numpy.minimum(self.count + steps, self.size)
+        # Until the window is full we average over the time elapsed so far
+        filling = counts < self.size
+        rates[:] = totals / self.window
+        numpy.divide(totals, elapsed, out = rates, \
+                     where = filling & (elapsed > 0))
+        rates[filling & (elapsed <= 0)] = 0
+
+        # Put the last size steps back in the ring buffer
+        self.index = (self.index + n) % self.size
+        last = window[-self.size:].tolist()
+        cut = self.size - self.index
+        self.steps = last[cut:] + last[:cut]
+        self.total = sum(self.steps)
+        self.count = int(counts[-1])
+        self.elapsed = float(elapsed[-1])
+        return rates
+
+
+    def rate(self):
+        """This function returns the current rate estimate in bits per second.
+           Until the window has filled up, we average over the time that has
+           actually elapsed."""
+        if (self.mode == EWMA):
+            if (self.weight == 0):
+                return 0
+            return self.average / self.weight
+        if (self.elapsed <= 0):
+            return 0
+        if (self.count < self.size):
+            return self.total / self.elapsed
+        return self.total / self.window
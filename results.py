@@ -0,0 +1,249 @@
+import json
+import os
+import queue
+import re
+import threading
+from bisect import bisect_right
+
+import numpy
+
+from metrics import bucket_range, samples
+
+# Formats the metrics can be written in. "bin" writes one file of raw
+# little-endian float64 samples per series, one sample per sampling interval
+# (NaN where nothing was recorded). "npz" writes each chunk of a series to its
+# own compressed .npz file. "csv" writes one time,value row per sample.
+BIN = "bin"
+NPZ = "npz"
+CSV = "csv"
+FORMATS = [BIN, NPZ, CSV]
+
+# The file describing the series in a results directory
+MANIFEST = "manifest.json"
+
+class ResultWriter:
+    def __init__(self, directory, format, dt, length, maxchunks=64):
+        """This function initializes a writer that streams metric chunks to
+           disk from a background thread while the simulation runs.
+           INPUT ARGUMENTS-
+               directory : The directory to write the results to
+               format : One of FORMATS
+               dt : The length of a timestep (in s)
+               length : The number of timesteps in the run
+               maxchunks : The number of chunks that can be waiting to be
+                           written before the simulation has to wait for the
+                           writer, which bounds the memory used
+           FIELDS-
+               series : A dictionary of key : manifest entry for that series
+               metadata : Other information to save in the manifest
+               chunks : The queue of chunks waiting to be written
+               files : Open files and the number of samples written to them,
+                       for each series (only used by the writer thread)
+               error : The exception the writer thread failed with, if any"""
+        if format not in FORMATS:
+            raise ValueError("unknown results format " + str(format))
+        os.makedirs(directory, exist_ok = True)
+        self.directory = directory
+        self.format = format
+        self.dt = dt
+        self.length = length
+        self.series = {}
+        self.metadata = {}
+        self.chunks = queue.Queue(maxsize = maxchunks)
+        self.files = {}
+        self.error = None
+        self.thread = threading.Thread(target = self.work, daemon = True)
+        self.thread.start()
+
+
+    def add_series(self, key, period, aggregate):
+        """This function registers a series, and picks the file it goes in."""
+        name = "%03d_%s" % (len(self.series), \
+                            re.sub("[^A-Za-z0-9]+", "_", key).strip("_"))
+        entry = {"file" : name, "period" : period, "aggregate" : aggregate}
+        if self.format == NPZ:
+            entry["chunks"] = []
+        self.series[key] = entry
+
+
+    def write(self, key, offset, values):
+        """This function queues the samples values, the first of which is for
+           sampling interval offset of the series key, to be written."""
+        if self.error is not None:
+            raise self.error
+        self.chunks.put((key, offset, values))
+
+
+    def work(self):
+        """The writer thread, which writes chunks until it is told to stop.
+           If writing fails we keep taking chunks off the queue so that the
+           simulation isn't blocked, and report the error from write()."""
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                self.write_chunk(*chunk)
+            except Exception as e:
+                self.error = e
+
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+
+    def write_chunk(self, key, offset, values):
+        entry = self.series[key]
+        if self.format == NPZ:
+            numpy.savez_compressed(self.path("%s.%d.npz" % (entry["file"], \
+                                   offset)), values = values)
+            entry["chunks"].append([offset, len(values)])
+            return
+
+        if key not in self.files:
+            if self.format == BIN:
+                self.files[key] = [open(self.path(entry["file"] + ".f64"), \
+                                        "wb"), 0]
+            else:
+                f = open(self.path(entry["file"] + ".csv"), "w")
+                f.write("time,value\n")
+                self.files[key] = [f, 0]
+        (f, written) = self.files[key]
+
+        if self.format == BIN:
+            # Sample i is always at byte 8*i, so fill any gap with NaNs.
+            if offset > written:
+                f.write(numpy.full(offset - written, numpy.nan, '<f8').tobytes())
+            f.write(values.astype('<f8').tobytes())
+        else:
+            buckets = numpy.flatnonzero(~numpy.isnan(values))
+            times = (offset + buckets) * entry["period"] * self.dt
+            for (t, v) in zip(times, values[buckets]):
+                f.write(repr(float(t)) + "," + repr(float(v)) + "\n")
+        self.files[key][1] = offset + len(values)
+
+
+    def close(self):
+        """This function waits for every chunk to be written, and writes the
+           manifest."""
+        self.chunks.put(None)
+        self.thread.join()
+        for (key, (f, written)) in self.files.items():
+            if self.format == BIN:
+                # Pad every column out to the full length of the run.
+                buckets = -(-self.length // self.series[key]["period"])
+                if buckets > written:
+                    f.write(numpy.full(buckets - written, numpy.nan, \
+                                       '<f8').tobytes())
+            f.close()
+        if self.error is not None:
+            raise self.error
+
+        manifest = {"format" : self.format, "dt" : self.dt,
+                    "length" : self.length, "series" : self.series}
+        manifest.update(self.metadata)
+        with open(self.path(MANIFEST), "w") as f:
+            json.dump(manifest, f, indent = 4)
+
+
+
+class Results:
+    def __init__(self, directory):
+        """This function opens a results directory written by a ResultWriter
+           for reading. Nothing is read until it is asked for: "bin" columns
+           are memory-mapped, so only the pages covering the requested
+           timesteps are ever read, and "npz" chunks are found through the
+           (offset, length) index in the manifest. Results can be read with
+           the same functions as a MetricStore.
+           INPUT ARGUMENTS-
+               directory : The results directory
+           FIELDS-
+               dt : The length of a timestep (in s)
+               length : The number of timesteps in the run
+               format : The format the results were written in
+               filename : The input file the run was made from
+               hostflows : The tracked flows coming out of each host
+               series : A dictionary of key : manifest entry
+               columns : The arrays read so far, by key"""
+        self.directory = directory
+        with open(os.path.join(directory, MANIFEST)) as f:
+            manifest = json.load(f)
+        self.dt = manifest["dt"]
+        self.length = manifest["length"]
+        self.format = manifest["format"]
+        self.filename = manifest.get("filename")
+        self.hostflows = manifest.get("hostflows", {})
+        self.series = manifest["series"]
+        self.columns = {}
+
+
+    def keys(self):
+        return self.series.keys()
+
+
+    def __contains__(self, key):
+        return key in self.series
+
+
+    def period(self, key):
+        """This function returns the sampling interval of key, in timesteps."""
+        return self.series[key]["period"]
+
+
+    def path(self, key):
+        return os.path.join(self.directory, self.series[key]["file"])
+
+
+    def column(self, key):
+        """This function returns the whole column of samples for key, for the
+           formats we don't read in pieces."""
+        if key in self.columns:
+            return self.columns[key]
+        buckets = -(-self.length // self.period(key))
+        path = self.path(key)
+        if self.format == BIN and os.path.exists(path + ".f64"):
+            column = numpy.memmap(path + ".f64", '<f8', mode = "r")
+        else:
+            column = numpy.full(buckets, numpy.nan)
+            if self.format == CSV and os.path.exists(path + ".csv"):
+                rows = numpy.loadtxt(path + ".csv", delimiter = ",", \
+                                     skiprows = 1, ndmin = 2)
+                intervals = numpy.rint(rows[:, 0] / \
+                    (self.dt * self.period(key))).astype(int)
+                column[intervals] = rows[:, 1]
+        self.columns[key] = column
+        return column
+
+
+    def values(self, key, start=0, end=None):
+        """This function returns the first interval and the samples (NaN where
+           nothing was recorded) for key, for timesteps start to end."""
+        period = self.period(key)
+        (first, last) = bucket_range(period, start, end, \
+                                     -(-self.length // period))
+        if self.format != NPZ:
+            return (first, numpy.array(self.column(key)[first:last]))
+
+        # Only load the chunks that overlap the range we want.
+        values = numpy.full(last - first, numpy.nan)
+        chunks = self.series[key]["chunks"]
+        ends = [offset + length for (offset, length) in chunks]
+        for i in range(bisect_right(ends, first), len(chunks)):
+            (offset, length) = chunks[i]
+            if offset >= last:
+                break
+            with numpy.load("%s.%d.npz" % (self.path(key), offset)) as chunk:
+                chunkvalues = chunk["values"]
+            lo = max(offset, first)
+            hi = min(offset + length, last)
+            values[lo - first:hi - first] = chunkvalues[lo - offset:hi - offset]
+        return (first, values)
+
+
+    def samples(self, key, start=0, end=None):
+        """This function returns the timesteps and values recorded for key,
+           from timestep start up to (not including) end."""
+        (first, values) = self.values(key, start, end)
+        return samples(first, self.period(key), values)
@@ -1,27 +1,54 @@
-from packet import Packet
+import heapq
+
+from packet import Packet, make_packet, release
 import globals
 
+INFINITY = float('inf')
+
 class Router:
-    def __init__(self, id, links):
+    def __init__(self, context, id, links):
         '''
         The function initializes a router object:
         Initial Arguments:
+            - context : the SimulationContext of the run the router is part of
             - id : id of the router
             - links : list of links connected to the router
         Attributes:
+            - context : the SimulationContext of the run the router is part of
             - id : id of the router
             - ip : IP address of the the router
             - links : list of links connected to the router
+            - link_by_id : dictionary of id : link, for the links connected to the router
             - routing_table : routing table to get packets to their dest
-            - link_state_array : keeps track of states of all links
+            - fib : forwarding table, the half link to send packets down for each dest
+            - lsdb : link state database, keeps track of states of all links as a
+              dictionary of source : {destination : [link id, cost]}
+            - incoming : the same entries, as destination : {source : [link id, cost]}
+            - own_links : (source, destination) of the entries for our own links
+            - seqnum : sequence number of the last link state advertisement we sent
+            - sequence : sequence number of the newest advertisement we have seen from
+              each other router
+            - dist : cost of the shortest path to each node we can reach
+            - parent : (previous node, link id) on the shortest path to each node
+            - children : nodes whose shortest path goes through each node last
             - handshakes_acked : keep strack of how many handshake acknowledgements are
               received, so that we know when our routing table is done
         '''
+        self.context = context
         self.id = id
         self.ip = 0
         self.links = links
+        self.link_by_id = {l.id: l for l in links}
         self.routing_table = {self.id: ['']}
-        self.link_state_array = []
+        self.fib = {}
+        self.lsdb = {}
+        self.incoming = {}
+        self.own_links = []
+        self.seqnum = 0
+        self.sequence = {}
+        self.dist = {self.id: 0}
+        self.parent = {}
+        self.children = {}
         self.handshakes_acked = 0
 
     '''
@@ -34,18 +61,21 @@ class Router:
         # If the packet is a handshake packet, send back a handshake acknowledgement
         if (packet.is_handshake()):
             data = self.id
-            ack = Packet(self.id, None, packet.get_source(), None, globals.HANDSHAKEACK, data = data)
+            ack = make_packet(self.context, self.id, None, packet.get_source(), None, \
+                              globals.HANDSHAKEACK, data = data)
 
             # Add the acknowledgement packet to the buffer on the link that sent the data
-            globals.idmapping['links'][linkid].add_to_buffer(ack, self.id)
+            self.link_by_id[linkid].add_to_buffer(ack, self.id)
 
         # Process a handshack acknowledgement
         elif(packet.is_handshake_ack()):
             self.receive_handshake_ack(packet, linkid)
+            release(self.context, packet)
 
-        # Process a routing (link state array) packet
+        # Process a routing (link state advertisement) packet
         elif(packet.is_routing()):
-            self.receive_link_state(packet.data)
+            self.receive_link_state(packet.data, linkid)
+            release(self.context, packet)
 
         # forward any other type of packet
         else:
@@ -57,9 +87,8 @@ class Router:
         - packet: the packet to be forwarded
     '''
     def forward_packet(self, packet):
-        # Looks up destination on routing table
-        link_path = self.routing_table.get(packet.get_destination())
-        globals.idmapping['links'][link_path].add_to_buffer(packet, self.id)
+        # Looks up destination on the forwarding table
+        self.fib[packet.destinationid].send(packet)
 
 
     '''
@@ -76,28 +105,43 @@ class Router:
 
     # Recalculates the link states
     '''
-    This function recalculates our link state array for all links that are connected to 
-    our router and sends the updated link state array to the adjacent
+    This function recalculates our link state for all links that are connected to 
+    our router and, if it changed, advertises it to the adjacent routers
     '''
     def recalc_link_state(self):
-        # Updating the link_state_array
-        for l in self.links:
-            # For every connection in the link state array, check if it uses one of our links
-            for conn in self.link_state_array:
-                if (l.id == conn[2]):
-                    lin = globals.idmapping['links'][conn[2]]
-                    conn[3] = lin.get_effective_rate(conn[0]) + lin.get_delay()
-        # send our new link state array
-        self.send_link_state()
+        # Updating the link state of every connection that uses one of our links
+        changes = []
+        for (src, dst) in self.own_links:
+            entry = self.lsdb[src][dst]
+            lin = self.link_by_id[entry[0]]
+            cost = lin.get_effective_rate(src) + lin.get_delay()
+            if cost != entry[1]:
+                entry[1] = cost
+                changes.append((src, dst))
+        # update our routing table and advertise our new link state (we always advertise
+        # it the first time, once our handshakes are done)
+        if changes:
+            self.update_routes(changes)
+        if changes or self.seqnum == 0:
+            self.seqnum += 1
+            advertisement = (self.id, self.seqnum, tuple((src, dst) + \
+                tuple(self.lsdb[src][dst]) for (src, dst) in self.own_links))
+            self.send_link_state(advertisement)
 
     '''
-    This function sends the current link state array for our router down all of the 
-    routers connected links
+    This function sends a link state advertisement down all of the routers connected links
+    Arguments:
+        - advertisement: (originating router, sequence number, entries), where the entries
+          are (source, destination, link id, cost) for each of the originating routers links.
+          It is never changed after it is made, so the same one can go in every packet.
+        - exclude: the id of a link not to send it down
     '''
-    def send_link_state(self):
+    def send_link_state(self, advertisement, exclude=None):
         for l in self.links:
-            routing_table_packet = \
-                Packet(self.id, None, None, None, globals.ROUTINGPACKET, data = self.link_state_array)
+            if (l.id == exclude):
+                continue
+            routing_table_packet = make_packet(self.context, self.id, None, None, None, \
+                globals.ROUTINGPACKET, data = advertisement)
             l.add_to_buffer(routing_table_packet, self.id)
 
     '''
@@ -110,108 +154,214 @@ class Router:
     def receive_handshake_ack(self, packet, linkid):
         # increment the amount of acknowledgements we recieved
         self.handshakes_acked += 1
-        link = globals.idmapping['links'][linkid]
+        link = self.link_by_id[linkid]
         other_router = packet.get_data().split(' ')[0]
 
-        # add to our link state array both directions of the connection that we just determined
-        self.link_state_array.append([self.id, other_router, linkid, link.get_delay() \
-            + link.get_effective_rate(self.id)])
-        self.link_state_array.append([other_router, self.id, linkid, link.get_delay() + \
-            link.get_effective_rate(other_router)])
+        # add to our link state database both directions of the connection that we just determined
+        self.set_link_state(self.id, other_router, linkid, link.get_delay() \
+            + link.get_effective_rate(self.id))
+        self.set_link_state(other_router, self.id, linkid, link.get_delay() + \
+            link.get_effective_rate(other_router))
+        self.own_links.append((self.id, other_router))
+        self.own_links.append((other_router, self.id))
 
-        # if we acknowledged all of our links, send out our link state array to adjacent routers,
-        # and then recaclulate our routing table using dijsktras
+        # if we acknowledged all of our links, caclulate our routing table using dijsktras,
+        # and then send out our link state to adjacent routers
         if self.handshakes_acked == len(self.links):
-            self.recalc_link_state()
             self.run_dijkstra()
+            self.recalc_link_state()
             self.handshakes_acked = 0
 
     '''
-    This function determines what a router should do when it recieves the link state array from 
-    an adjacent router
+    This function sets the entry for the connection from src to dst in our link state
+    database, and returns whether it changed
+    '''
+    def set_link_state(self, src, dst, linkid, cost):
+        entry = self.lsdb.setdefault(src, {}).get(dst)
+        if entry is None:
+            entry = [linkid, cost]
+            self.lsdb[src][dst] = entry
+            self.incoming.setdefault(dst, {})[src] = entry
+            return True
+        if entry[0] == linkid and entry[1] == cost:
+            return False
+        entry[0] = linkid
+        entry[1] = cost
+        return True
+
+    '''
+    This function determines what a router should do when it recieves a link state advertisement
+    from an adjacent router
     Arguments:
-        - state_array_actual: this is the link state array that the router is recieving
+        - advertisement: this is the advertisement that the router is recieving, as made by
+          recalc_link_state
+        - linkid: the id of the link that the advertisement was recieved from
     '''
-    def receive_link_state(self, state_array_actual):
-        state_array = state_array_actual.copy()
-        is_updated = False
+    def receive_link_state(self, advertisement, linkid):
+        (origin, seqnum, entries) = advertisement
+        # Drop our own advertisements, and ones we have already seen (or that are older
+        # than one we have seen), without passing them on again
+        if (origin == self.id or seqnum <= self.sequence.get(origin, 0)):
+            return
+        self.sequence[origin] = seqnum
+
+        changes = []
+        for (src, dst, link, cost) in entries:
+            # we know the state of our own links better than anyone else
+            if self.id in (src, dst):
+                continue
+            if self.set_link_state(src, dst, link, cost):
+                changes.append((src, dst))
+
+        # if anything changed, update our routing table, and pass the news on to everyone
+        # but the router it came from
+        if changes:
+            self.update_routes(changes)
+        self.send_link_state(advertisement, exclude = linkid)
 
-        # remove all values in the recieved array that contain our current router
-        for value in state_array:
-            if self.id in (value[0], value[1]):
-                state_array.remove(value)
+    '''
+    This function sets the shortest path to node to go through prev, over the link linkid
+    '''
+    def set_parent(self, node, prev, linkid):
+        old = self.parent.get(node)
+        if old is not None:
+            self.children[old[0]].discard(node)
+        if prev is None:
+            self.parent.pop(node, None)
+        else:
+            self.parent[node] = (prev, linkid)
+            self.children.setdefault(prev, set()).add(node)
 
+    '''
+    This function says whether the connection from prev over the link linkid should be the
+    shortest path to node instead of the one we have, when both cost the same. Of all the
+    shortest paths to a node, we always use the one whose last connection has the smallest
+    (previous node, link id), so the paths we keep up to date are the same as the ones we
+    would work out from scratch, whatever order the changes come in.
+    '''
+    def breaks_tie(self, node, prev, linkid):
+        old = self.parent.get(node)
+        return (old is not None and (prev, linkid) < old)
 
-        # check if we need to update anything based on the state array that we recieved
-        for item in state_array:
-            in_array = False
-            for value in self.link_state_array:
-                if (item[0], item[1]) == (value[0], value[1]):
-                    in_array = True
-                    if(value[3] != item[3]):
-                        value[3] = item[3]
-                        is_updated = True
+    '''
+    This function runs dijkstras algorithm from the nodes in heap (a heap of (cost, node)),
+    whose costs have already been lowered, until no more paths get shorter. Paths that cost
+    the same as the shortest one are chosen between with breaks_tie.
+    '''
+    def relax(self, heap):
+        while heap:
+            (d, node) = heapq.heappop(heap)
+            if d > self.dist.get(node, INFINITY):
+                continue
+            for (nxt, (linkid, cost)) in self.lsdb.get(node, {}).items():
+                if d + cost < self.dist.get(nxt, INFINITY):
+                    self.dist[nxt] = d + cost
+                    self.set_parent(nxt, node, linkid)
+                    heapq.heappush(heap, (d + cost, nxt))
+                elif (d + cost == self.dist.get(nxt) and self.breaks_tie(nxt, node, linkid)):
+                    # Just as short, so nothing past nxt changes
+                    self.set_parent(nxt, node, linkid)
 
-            if in_array == False:
-                self.link_state_array.append(item)
-                is_updated = True
+    '''
+    This function updates the shortest paths after the connections in changes (a list of
+    (source, destination)) have changed cost, and then rebuilds the routing table. Only the
+    nodes whose shortest paths could be affected are looked at again: if a connection got
+    cheaper, the paths it now shortens, and if a connection on a shortest path got more
+    expensive, the nodes whose paths went through it. The shortest paths end up the same as
+    the ones run_dijkstra would find, ties included (see breaks_tie).
+    '''
+    def update_routes(self, changes):
+        for (src, dst) in changes:
+            (linkid, cost) = self.lsdb[src][dst]
+            if dst == self.id or src not in self.dist:
+                continue
+            if self.parent.get(dst, (None, None))[0] == src:
+                # The connection is on the shortest path to dst
+                if self.dist[src] + cost < self.dist[dst]:
+                    self.dist[dst] = self.dist[src] + cost
+                    self.set_parent(dst, src, linkid)
+                    self.relax([(self.dist[dst], dst)])
+                else:
+                    # It may no longer be the shortest path, or (if only the link id
+                    # changed) no longer win the tie with the others that cost the same
+                    self.reroute(dst)
+            elif self.dist[src] + cost < self.dist.get(dst, INFINITY):
+                self.dist[dst] = self.dist[src] + cost
+                self.set_parent(dst, src, linkid)
+                self.relax([(self.dist[dst], dst)])
+            elif (self.dist[src] + cost == self.dist.get(dst) and \
+                  self.breaks_tie(dst, src, linkid)):
+                self.set_parent(dst, src, linkid)
+        self.build_routing_table()
 
-        # run dijkstras and send our link state after we recieve someone elses link state
-        self.run_dijkstra()
-        if is_updated:
-            self.send_link_state()
+    '''
+    This function finds new shortest paths for node and every node whose shortest path goes
+    through it, after the connection to node got more expensive.
+    '''
+    def reroute(self, node):
+        # Find every node whose path goes through node, and forget their paths
+        subtree = [node]
+        for n in subtree:
+            subtree.extend(self.children.get(n, ()))
+        affected = set(subtree)
+        for n in subtree:
+            del self.dist[n]
+            self.set_parent(n, None, None)
 
+        # The best way into each of them from a node whose path is unaffected
+        heap = []
+        for n in subtree:
+            for (prev, (linkid, cost)) in self.incoming.get(n, {}).items():
+                if prev in affected or prev not in self.dist:
+                    continue
+                if self.dist[prev] + cost < self.dist.get(n, INFINITY):
+                    self.dist[n] = self.dist[prev] + cost
+                    self.set_parent(n, prev, linkid)
+                elif (self.dist[prev] + cost == self.dist[n] and \
+                      self.breaks_tie(n, prev, linkid)):
+                    self.set_parent(n, prev, linkid)
+            if n in self.dist:
+                heapq.heappush(heap, (self.dist[n], n))
+        self.relax(heap)
 
     '''
-    This function runs dijkstras shortest path algorithm on the routers link state array to determine
-    the routers routing table
+    This function runs dijkstras shortest path algorithm on the routers link state database
+    from scratch to determine the routers routing table. Where there is more than one shortest
+    path to a node, the one whose last connection has the smallest (previous node, link id)
+    is used.
     '''
     def run_dijkstra(self):
-        unvisited_nodes = []
-        nodes = {}
-        start_node = self.id
-        seen_nodes = []
-
-        # Populate unvisited nodes list
-        for item in self.link_state_array:
-            unvisited_nodes.append(item[0])
-
-        unvisited_nodes = list(set(unvisited_nodes))
-        unvisited_nodes = sorted(unvisited_nodes)
-
-        # Initialize all nodes as infinity distance
-        for item in unvisited_nodes:
-            nodes[item] = [float('inf'), '']
-
-        nodes[start_node] = [0, '']
-        current_node = start_node
-        seen_nodes.append(start_node)
-
-        # While we have unvisited nodes, continue loopping
-        while unvisited_nodes != []:
-
-            # Remove the node we are currently on
-            unvisited_nodes.remove(current_node)
-
-            # Find the shortest path from that start node
-            for item in self.link_state_array:
-                if item[0] == current_node:
-                    if(item[3] + nodes[current_node][0] < nodes[item[1]][0]):
-                        if(nodes[current_node][1] == ''):
-                            nodes[item[1]] = [item[3] + nodes[current_node][0], item[2]]
-                        else:
-                            nodes[item[1]] = [item[3] + nodes[current_node][0], \
-                                nodes[current_node][1]]
-                    if item[1] not in seen_nodes:
-                        seen_nodes.append(item[1])
-                        
-            # determine which node we should use next
-            if unvisited_nodes != []:
-                for node in unvisited_nodes:
-                    if node in seen_nodes:
-                        current_node = node
-                        break
+        self.dist = {self.id: 0}
+        self.parent = {}
+        self.children = {}
+        self.relax([(0, self.id)])
+        self.build_routing_table()
+
+    '''
+    This function builds the routing table, which gives the link to send packets for each
+    node down, from the shortest paths, and compiles it into the forwarding table if it
+    changed
+    '''
+    def build_routing_table(self):
         rt = {}
-        for key in nodes:
-            rt[key] = nodes.get(key)[1]
+        for node in self.lsdb:
+            rt[node] = ''
+        rt[self.id] = ''
+
+        def first_link(node):
+            if node not in rt or rt[node] == '':
+                (prev, linkid) = self.parent[node]
+                rt[node] = linkid if prev == self.id else first_link(prev)
+            return rt[node]
+
+        for node in self.parent:
+            first_link(node)
+        if (rt == self.routing_table):
+            return
         self.routing_table = rt
+
+        fib = {}
+        for (node, linkid) in rt.items():
+            if (linkid != ''):
+                fib[node] = self.link_by_id[linkid].links[self.id]
+        self.fib = fib
@@ -0,0 +1,408 @@
+import heapq
+from bisect import insort
+
+import numpy
+
+import globals
+from timerwheel import TimerWheel
+
+# Routers recalculate their link state every 5 seconds.
+RECALCTICKS = 50000
+
+# Number of timesteps a link stays active for after it empties. Running an
+# empty link costs the same as filling in its idle timesteps later, so this
+# just saves the bookkeeping for links that are only empty for a moment.
+LINGERTICKS = 100
+
+# Number of timesteps whose times a Timeline works out at once, and the
+# number of those chunks it keeps.
+TIMESCHUNK = 1 << 14
+TIMESCACHED = 4
+
+class Timeline:
+    """
+    This class gives the value of systime at each timestep of a run. We
+    accumulate it the same way the dt loop always has, so that the timesteps
+    fall at exactly the same times, but only TIMESCHUNK timesteps at a time,
+    when they are first needed. Only the time at the start of each chunk and
+    the last few chunks used are kept, so a long run doesn't need memory for
+    every timestep.
+
+    Input arguments:
+        - start : systime at timestep 0
+        - duration : number of timesteps in the run; there is a time for
+                     every timestep from 0 to duration
+    Attributes:
+        - dt : the length of a timestep
+        - firsts : firsts[c] is the time at the first timestep of chunk c,
+                   for every chunk up to the furthest one worked out
+        - chunks : the times of the last few chunks used, by chunk, most
+                   recently used last
+        - chunk, values : the chunk used last and its times
+    """
+    def __init__(self, start, duration):
+        self.duration = duration
+        self.dt = globals.dt
+        self.firsts = [start]
+        self.chunks = {}
+        self.chunk = None
+        self.values = None
+
+    def __len__(self):
+        return self.duration + 1
+
+    def accumulate(self, c):
+        """Returns the times of the timesteps in chunk c, as a list. The
+           steps are added one at a time, in order, just like the dt loop."""
+        steps = numpy.full(TIMESCHUNK, self.dt)
+        steps[0] = self.firsts[c]
+        return numpy.add.accumulate(steps).tolist()
+
+    def load(self, c):
+        """Makes chunk c the one used last, working it out if need be."""
+        values = self.chunks.pop(c, None)
+        if values is None:
+            # Sum up the chunks before it that haven't been yet, to know
+            # where it starts
+            while len(self.firsts) <= c:
+                times = self.accumulate(len(self.firsts) - 1)
+                self.firsts.append(times[-1] + self.dt)
+            values = self.accumulate(c)
+            if len(self.chunks) >= TIMESCACHED:
+                del self.chunks[next(iter(self.chunks))]
+        self.chunks[c] = values
+        (self.chunk, self.values) = (c, values)
+
+    def __getitem__(self, k):
+        """Returns the time at timestep k, or a list of the times at the
+           timesteps in a slice of them."""
+        if isinstance(k, slice):
+            (first, end, _) = k.indices(self.duration + 1)
+            times = []
+            while first < end:
+                c = first // TIMESCHUNK
+                if c != self.chunk:
+                    self.load(c)
+                last = min(end, (c + 1) * TIMESCHUNK)
+                times.extend(self.values[first - c * TIMESCHUNK: \
+                                         last - c * TIMESCHUNK])
+                first = last
+            return times
+        if k < 0 or k > self.duration:
+            raise IndexError("timestep %d is not in the run" % k)
+        c = k // TIMESCHUNK
+        if c != self.chunk:
+            self.load(c)
+        return self.values[k - c * TIMESCHUNK]
+
+    def bisect(self, time, lo=0):
+        """Returns the first timestep from lo on whose time is at least time,
+           or duration + 1 if there isn't one, like bisect_left would on a
+           list of every time. As the times are dt apart, we can work out
+           about where it is and only look at the timesteps around there."""
+        if lo > self.duration or self[lo] >= time:
+            return lo
+        k = lo + int((time - self[lo]) / self.dt)
+        k = min(max(k, lo + 1), self.duration + 1)
+        while k - 1 > lo and self[k - 1] >= time:
+            k -= 1
+        while k <= self.duration and self[k] < time:
+            k += 1
+        return k
+
+
+class TickScheduler:
+    """
+    This class runs the simulation with the fixed dt loop, but only over the
+    links and flows that are active. A link becomes active when a packet is
+    added to it, and stops being active once it has nothing left to send or
+    deliver (for a little while, see LINGERTICKS). Timesteps in which a link
+    was idle are filled in the first time anything looks at that link again
+    (when a packet is added to it, when a router reads its rate, or at the
+    end of the run), so that the metrics match running every link in every
+    timestep. A flow becomes active at its start time, and stops being active
+    once it is done; only tracked flows are ever active, as the others have
+    no statistics to record. Each timestep we run the active links and record
+    the statistics of the active flows, and only run a flow itself when an ACK
+    reaches it or one of its timers (its start time or retransmission
+    timeout, kept in a TimerWheel) goes off, so the cost of a timestep
+    follows how much is going on rather than the size of the network. While
+    there are no active links, we skip ahead to the next flow timer.
+
+    Input arguments:
+        - context : the SimulationContext of the run
+        - duration : number of timesteps to run the simulation for
+    Attributes:
+        - times : Timeline giving the value of systime at each timestep
+        - timers : TimerWheel of the timestep each flow next has to run at
+        - tick : the timestep currently being processed
+        - position : index of the link currently being run, or the number
+                     of links once we are past the links in this timestep
+        - link_synced : last timestep each link has been run or filled in for
+        - pending_links : heap of the links that must still run in the
+                          current timestep
+        - started : whether the run has been started
+        - active_links/active_flows : indices of the active links and
+                                      flows, in order
+        - link_active/flow_active : whether each link and flow is active
+        - emptied : the timestep each active link last became empty at
+        - starts : (timestep, index) of every tracked flow, in the order they
+                   start in
+        - flows_started : the number of flows in starts that have started
+        - due : indices of the flows that have to run in this timestep
+        - next_tick : the timestep to carry on from
+
+    A run can be stopped at any timestep and carried on from there later, by
+    calling run() again (after saving and loading it with everything else in
+    the simulation, if need be).
+    """
+    def __init__(self, context, duration):
+        self.context = context
+        self.duration = duration
+        self.links = list(self.context.idmapping['links'].values())
+        self.flows = list(self.context.idmapping['flows'].values())
+        self.link_index = {link: i for (i, link) in enumerate(self.links)}
+        self.flow_index = {flow: i for (i, flow) in enumerate(self.flows)}
+
+        self.times = Timeline(context.systime, duration)
+        self.timers = TimerWheel()
+        self.tick = 0
+        self.position = -1
+        self.link_synced = [-1] * len(self.links)
+        self.pending_links = []
+        self.started = False
+
+        self.active_links = []
+        self.active_flows = []
+        self.link_active = [False] * len(self.links)
+        self.flow_active = [False] * len(self.flows)
+        self.emptied = [None] * len(self.links)
+        self.starts = sorted((self.times.bisect(flow.start), j) \
+                             for (j, flow) in enumerate(self.flows) \
+                             if flow.track)
+        self.flows_started = 0
+        self.due = set()
+        self.next_tick = 0
+
+    def tick_at(self, time):
+        """Returns the first timestep after the current one at which
+           systime will have reached time."""
+        return self.times.bisect(time, self.tick + 1)
+
+    def reschedule_flow(self, j):
+        time = self.flows[j].next_event_time()
+        wake = None if time is None else self.tick_at(time)
+        if wake is None or wake >= self.duration:
+            self.timers.cancel(j)
+        else:
+            self.timers.schedule(j, wake)
+
+    def fill_link(self, q, target):
+        """Fills in the timesteps up to and including target, in which the
+           link was idle, all at once."""
+        link = self.links[q]
+        first = self.link_synced[q] + 1
+        if target < first:
+            return
+        # A chunk of times at a time, so that a long stretch doesn't need
+        # memory for all of it at once
+        while first <= target:
+            end = min(target + 1, (first // TIMESCHUNK + 1) * TIMESCHUNK)
+            link.fill_idle(first, self.times[first:end])
+            first = end
+        self.link_synced[q] = target
+
+    def sync_link(self, link):
+        """Brings link up to date before something reads it. If the link's
+           turn in this timestep has already passed, that turn was idle too."""
+        q = self.link_index[link]
+        if q < self.position:
+            self.fill_link(q, self.tick)
+        elif q > self.position:
+            self.fill_link(q, self.tick - 1)
+        return q
+
+    def run_link(self, q):
+        """Runs link q in the current timestep, after filling in the
+           timesteps it was idle for."""
+        self.position = q
+        if self.link_synced[q] < self.tick - 1:
+            self.fill_link(q, self.tick - 1)
+        link = self.links[q]
+        # Update the statistics before sending, or it would seem like the
+        # buffer is not being used to capacity although it is
+        link.update_link_statistics()
+        link.send_packet()
+        self.link_synced[q] = self.tick
+
+    def wake_link(self, link):
+        """Called before a packet is added to link. The link runs later in
+           this timestep if its turn hasn't come yet, and from the next
+           timestep otherwise."""
+        q = self.link_index[link]
+        self.emptied[q] = None
+        # Active links are always up to date
+        if self.link_active[q]:
+            return
+        self.sync_link(link)
+        if q > self.position:
+            heapq.heappush(self.pending_links, q)
+        insort(self.active_links, q)
+        self.link_active[q] = True
+
+    def wake_flow(self, flow):
+        """Called before an ACK is processed by flow. Flows run after the
+           links, so the flow will run later in this timestep."""
+        self.due.add(self.flow_index[flow])
+
+    def idle_until(self):
+        """Returns the first timestep at which a flow has something to do if
+           there are no packets anywhere in the network (so nothing can happen
+           before then), and None otherwise."""
+        if self.due:
+            return None
+        for q in self.active_links:
+            if not self.links[q].is_empty():
+                return None
+        wake = self.timers.next_expiry()
+        return self.duration if wake is None else wake
+
+    def fill_flows(self, end):
+        """Records the statistics of the active flows for the timesteps from
+           the current one up to (not including) end, in which nothing
+           happens, all at once."""
+        first = self.tick
+        # A chunk of times at a time, as in fill_link
+        while first < end:
+            last = min(end, (first // TIMESCHUNK + 1) * TIMESCHUNK)
+            times = self.times[first:last]
+            for j in self.active_flows:
+                self.flows[j].fill_flow_statistics(first, times)
+            first = last
+
+    def step(self):
+        """Runs the active links and flows for the current timestep."""
+        i = self.tick
+        self.context.systime = self.times[i]
+        self.context.tick = i
+        while self.flows_started < len(self.starts) and \
+              self.starts[self.flows_started][0] <= i:
+            j = self.starts[self.flows_started][1]
+            if not self.flow_active[j]:
+                insort(self.active_flows, j)
+                self.flow_active[j] = True
+            self.flows_started += 1
+        self.due.update(self.timers.advance(i))
+
+        # Send packets from links. The active links are kept in order, so
+        # they are a heap as they are.
+        self.pending_links = list(self.active_links)
+        while self.pending_links:
+            q = heapq.heappop(self.pending_links)
+            if self.link_synced[q] == i:
+                continue
+            self.run_link(q)
+            if not self.links[q].is_empty():
+                self.emptied[q] = None
+            elif self.emptied[q] is None:
+                self.emptied[q] = i
+            elif i - self.emptied[q] >= LINGERTICKS:
+                self.active_links.remove(q)
+                self.link_active[q] = False
+                self.emptied[q] = None
+        self.position = len(self.links)
+
+        # Send link states every 5 seconds
+        if (i+1) % RECALCTICKS == 0:
+            print("systime : ", self.context.systime)
+
+            for router in self.context.idmapping['routers'].values():
+                router.recalc_link_state()
+
+        # Send out packets from the flows that have something to do, in
+        # order. Only the few flows that are due but not active need sorting.
+        waiting = sorted(j for j in self.due if not self.flow_active[j])
+        finished = []
+        for j in heapq.merge(self.active_flows, waiting):
+            flow = self.flows[j]
+            if j in self.due:
+                flow.run()
+                self.reschedule_flow(j)
+            flow.update_flow_statistics()
+            if flow.done and self.flow_active[j]:
+                finished.append(j)
+        for j in finished:
+            self.active_flows.remove(j)
+            self.flow_active[j] = False
+        self.due.clear()
+        self.position = -1
+
+    def move_flow(self, flow):
+        """Called when the start time of flow is changed while the run is
+           stopped, to move its start timer and when it becomes active."""
+        j = self.flow_index[flow]
+        waiting = [(k, f) for (k, f) in self.starts[self.flows_started:] \
+                   if f != j]
+        if flow.track:
+            waiting.append((self.times.bisect(flow.start), j))
+        self.starts = self.starts[:self.flows_started] + sorted(waiting)
+        self.reschedule_flow(j)
+
+    def finish_links(self):
+        """Fills in the idle timesteps of every link at the end of the run."""
+        self.tick = self.duration - 1
+        self.position = len(self.links)
+        for q in range(len(self.links)):
+            self.fill_link(q, self.tick)
+
+    def run(self, until=None):
+        """Runs the simulation up to (not including) timestep until, or for
+           the full duration."""
+        if until is None or until > self.duration:
+            until = self.duration
+        self.context.scheduler = self
+        if not self.started:
+            # Everything runs in the first timestep, and sets its timers (or
+            # becomes inactive) from there
+            self.active_links = list(range(len(self.links)))
+            self.link_active = [True] * len(self.links)
+            self.due.update(range(len(self.flows)))
+            self.started = True
+        i = self.next_tick
+        while i < until:
+            self.tick = i
+
+            # If the network is empty, nothing can happen until the next flow
+            # starts or times out, so jump straight to that timestep (or the
+            # next link state recalculation, if that comes first), filling in
+            # the statistics of the flows for the timesteps in between all at
+            # once, and run it as usual. The links are filled in when they
+            # are next used.
+            wake = self.idle_until()
+            if wake is not None:
+                # Every link is empty, so none of them are active any more
+                for q in self.active_links:
+                    self.emptied[q] = None
+                    self.link_active[q] = False
+                self.active_links = []
+                recalc = (i // RECALCTICKS + 1) * RECALCTICKS - 1
+                end = min(wake, until, recalc)
+                if end > i:
+                    self.fill_flows(end)
+                    i = end
+                if i == until:
+                    break
+                self.tick = i
+
+            self.step()
+            i += 1
+        self.next_tick = i
+        if i < self.duration:
+            self.context.scheduler = None
+            return
+
+        # Fill in the idle timesteps of the links at the end of the run.
+        self.finish_links()
+        self.context.systime = self.times[self.duration]
+        self.context.tick = self.duration
+        self.context.scheduler = None
@@ -0,0 +1,33 @@
+class Scoreboard:
+    def __init__(self):
+        """This function initializes the record a host keeps of the packets it
+           has received from one flow, which it uses to find the cumulative
+           ACK number to send back.
+           FIELDS-
+               expected : The smallest packet id that hasn't been received,
+                          i.e. every packet before it has been received
+               outoforder : The ids of the packets received after expected,
+                            which are waiting for the gap to be filled"""
+        self.expected = 0
+        self.outoforder = set()
+
+
+    def receive(self, packetid):
+        """This function records that packetid was received and returns the
+           smallest packet id that still hasn't been received. Each packet is
+           only ever added to and removed from outoforder once, so this is
+           O(1) per packet on average."""
+        if (packetid == self.expected):
+            self.expected = self.expected + 1
+            # The packets that were waiting on this one are now in order
+            while self.expected in self.outoforder:
+                self.outoforder.remove(self.expected)
+                self.expected = self.expected + 1
+        elif (packetid > self.expected):
+            self.outoforder.add(packetid)
+        # Otherwise, it's a packet we already have
+        return self.expected
+
+
+    def __contains__(self, packetid):
+        return packetid < self.expected or packetid in self.outoforder
@@ -1,4 +1,3 @@
-import matplotlib.pyplot as plot
 import globals
 from host import Host
 from link import Link
@@ -6,10 +5,43 @@ from packet import Packet
 from flow_fast import Flow_FAST
 from router import Router
 from flow_reno import Flow
+from scheduler import TickScheduler
+from metrics import MetricStore
+from results import ResultWriter, Results, BIN
+from context import SimulationContext
 
+import copyreg
 import json
+import os
+import pickle
+import sys
 from pprint import pprint
 
+# The directory the simulator's modules are in
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def set_state(obj, state):
+    """Sets the attributes of an object loaded from a checkpoint one at a
+       time, in the order they were first set in. Python only keeps the
+       attributes of an object in its compact (and faster) form if they are
+       set like that, rather than by filling in its __dict__ as pickle does
+       by default, and the simulation spends most of its time reading them."""
+    for (key, value) in state.items():
+        setattr(obj, key, value)
+
+
+class CheckpointPickler(pickle.Pickler):
+    """Saves the objects of the simulator so that set_state loads them."""
+    def reducer_override(self, obj):
+        cls = type(obj)
+        module = sys.modules.get(cls.__module__)
+        if (module is None or not hasattr(module, "__file__") or \
+            os.path.dirname(os.path.abspath(module.__file__)) != HERE or \
+            not hasattr(obj, "__dict__")):
+            return NotImplemented
+        return (copyreg.__newobj__, (cls,), obj.__dict__, None, None, \
+                set_state)
+
 # This class runs a simulation of a network with a certain congestion
 # control algorithm.
 class Simulator:
@@ -18,26 +50,58 @@ class Simulator:
     file and creating the objects according to their specifications.
     Input arguments:
         - filename : name of the input file
+        - duration : how long to run the simulation for, in seconds
+        - output : directory to stream the metrics to while the simulation
+                   runs, or None to keep them in memory
+        - output_format : format to write the metrics in (see results.py)
+        - context : the SimulationContext to run in (by default, a new one
+                    with the current settings from globals)
+        - network : the network objects, as they would be loaded from an
+                    input file, to use instead of loading filename
     Attributes:
         - network_objects: 3-dimensional list of all network objects
+        - context : the SimulationContext holding the state of the run
+        - scheduler : the TickScheduler running the simulation, once it has
+                      started
     """
-    def __init__(self, filename, duration):
+    def __init__(self, filename, duration, output=None, \
+                 output_format=BIN, context=None, network=None):
+        if context is None:
+            context = SimulationContext()
+        self.context = context
         self.filename = filename
         # the duration of the simulation, in number of timesteps
         self.duration = int(duration / globals.dt)
+        self.output = output
+        self.scheduler = None
+        # Allocate room for every statistic for the whole run up front, or
+        # set up the writer if we're streaming them to disk
+        writer = None
+        if output is not None:
+            writer = ResultWriter(output, output_format, globals.dt, \
+                                  self.duration)
+            writer.metadata["filename"] = filename
+        sampling = {}
+        for (m, interval) in context.sampleinterval.items():
+            sampling[m] = (max(1, int(round(interval / globals.dt))), \
+                           context.sampleaggregate[m])
+        self.context.statistics = MetricStore(self.duration, sampling, \
+                                              writer, globals.dt)
         # Import the network object parameters
-        with open(self.filename) as f:
-            network_objects = json.load(f)
+        network_objects = network
+        if network_objects is None:
+            with open(self.filename) as f:
+                network_objects = json.load(f)
         # Create links
         for l in network_objects['links']:
             # Clear the variable
             link = None
 
             # Add to idmapping
-            link = Link(l['id'], l['connection1'], l['connection2'], \
+            link = Link(context, l['id'], l['connection1'], l['connection2'], \
                         l['rate'], l['delay'], l['buffersize'], l['track1'] == 1, \
                         l['track2'] == 1)
-            globals.idmapping['links'][l['id']] = link
+            self.context.idmapping['links'][l['id']] = link
 
         # Create hosts
         for h in network_objects['hosts']:
@@ -45,8 +109,8 @@ class Simulator:
             host = None
 
             # Add to idmapping
-            host = Host(h['id'], h['linkid'])
-            globals.idmapping['hosts'][h['id']] = host
+            host = Host(context, h['id'], h['linkid'])
+            self.context.idmapping['hosts'][h['id']] = host
 
         # Create routers
         if network_objects['routers'] != [{}]:
@@ -57,11 +121,11 @@ class Simulator:
                 # Get the list of links connected to each router
                 link_list = []
                 for lin_id in r['links']:
-                    link_list.append(globals.idmapping['links'][lin_id])
+                    link_list.append(self.context.idmapping['links'][lin_id])
 
                 # Initialize router and add to idmapping
-                router = Router(r['id'], link_list)
-                globals.idmapping['routers'][r['id']] = router
+                router = Router(context, r['id'], link_list)
+                self.context.idmapping['routers'][r['id']] = router
 
         # Create flows
         for f in network_objects['flows']:
@@ -70,175 +134,128 @@ class Simulator:
 
             # add to idmapping
             if f['congestion_control'] == 'reno':
-                flow = Flow(f['id'], f['source'], f['destination'], f['amount'], \
+                flow = Flow(context, f['id'], f['source'], f['destination'], f['amount'], \
                     f['start'], f['track'] == 1)
             else:
-                flow = Flow_FAST(f['id'], f['source'], f['destination'], f['amount'], \
+                flow = Flow_FAST(context, f['id'], f['source'], f['destination'], f['amount'], \
                     f['start'], f['track'] == 1)
 
 
-            globals.idmapping['flows'][f['id']] = flow
-
-    # prepares host metrics for tracking
-    def prepare_host_metrics(self):
-        """This function constructs a dictionaries tracking host send/recive
-           rates using the recorded flow send/recieve rates"""
-        for (h, host) in globals.idmapping['hosts'].items():
-            tracking = False
-            dict = {}
-            for (id, flow) in globals.idmapping['flows'].items():
+            self.context.idmapping['flows'][f['id']] = flow
+
+        self.compile_topology()
+
+    # Wires the network objects straight to each other
+    def compile_topology(self):
+        """This function replaces the ids that the network objects were given
+           in the input file with direct references to the objects they name,
+           now that they all exist, so that nothing needs to look an id up
+           while the simulation runs. Any id can name a host or a router."""
+        nodes = dict(self.context.idmapping['hosts'])
+        nodes.update(self.context.idmapping['routers'])
+        # Each half link delivers straight to the object at its far end
+        for link in self.context.idmapping['links'].values():
+            for halflink in link.links.values():
+                halflink.receiver = nodes[halflink.destination]
+        # Each host sends straight down its half of its link
+        for host in self.context.idmapping['hosts'].values():
+            host.link = self.context.idmapping['links'][host.linkid]
+            host.halflink = host.link.links[host.id]
+        # Each flow knows its ends, and the host it comes out of knows the
+        # flow so that it can hand it its ACKs
+        for flow in self.context.idmapping['flows'].values():
+            flow.source = nodes[flow.source]
+            flow.destination = nodes[flow.destination]
+            if isinstance(flow.source, Host):
+                flow.source.flows[flow.id] = flow
+
+    # Returns the tracked flows coming out of each host
+    def host_flows(self):
+        """This function returns a dictionary of host id : list of the ids of
+           the tracked flows that host is the source of, for the hosts that are
+           the source of at least one tracked flow"""
+        hostflows = {}
+        for (h, host) in self.context.idmapping['hosts'].items():
+            for (id, flow) in self.context.idmapping['flows'].items():
                 if flow.track and flow.source == host:
-                    if not tracking:
-                        dict = globals.statistics[id+":"+globals.FLOWRATE].copy()
-                        tracking = True
-                    else:
-                        newdict = globals.statistics[id+":"+globals.FLOWRATE]
-                        for i in dict.keys() | newdict.keys():
-                            if i in dict.keys() & newdict.keys():
-                                dict[i] = dict[i] + newdict[i]
-                            elif i in newdict.keys():
-                                dict[i] = newdict[i]
-            if tracking:
-                globals.statistics[h+":"+globals.HOSTFLOWRATE] = dict
-
+                    hostflows.setdefault(h, []).append(id)
+        return hostflows
 
     # Plots metrics based on data collected while the simulations was running
-    def plot_metrics(self):
-        self.prepare_host_metrics()
-        if (globals.PRESENTATIONMODE):
-            plot.rcParams.update({'font.size' : 12})
-            plot.tight_layout()
-        # Access all metrics
-        all_metrics = globals.LINKMETRICS + globals.HALFLINKMETRICS + \
-                      globals.FLOWMETRICS + [globals.HOSTFLOWRATE]
-        # For every timestep
-        for t in all_metrics:
-            legend = []
-            plot.figure(figsize = (12,4.5))
-            plot.xlim(xmax = self.duration*globals.dt)
-            #plot.ylim(ymin = 0)
-            print("Plotting ", t)
-            for s in globals.statistics.keys():
-                x = []
-                y = []
-                lines = 0
-                dict = globals.statistics[s]
-                #print(s)
-                name = s.split(":")
-                name.pop()
-                name = ":".join(name)
-
-                # Plot buffer occupancy
-                if globals.BUFFEROCCUPANCY in s and globals.BUFFEROCCUPANCY == t:
-                    for key in sorted(dict.keys()):
-                        x.append(key)
-                        # Converts the buffer occupancy from bits to Kilobytes
-                        y.append(dict[key]*globals.BITSTOKILOBITS/8)
-                    lines = plot.plot(x,y)
-                    plot.ylabel("buffer occupancy (in KB)")
-                    legend.append(name)
-
-                # Plot link rates
-                if globals.LINKRATE in s and globals.LINKRATE == t:
-                    for key in sorted(dict.keys()):
-                        x.append(key)
-                        y.append(dict[key]*globals.BITSTOMEGABITS)
-                    lines = plot.plot(x,y)
-                    plot.ylabel("link rate (in Mbps)")
-                    legend.append(name)
-
-                # Plot packet loss
-                if globals.PACKETLOSS in s and globals.PACKETLOSS == t:
-                    for key in sorted(dict.keys()):
-                        x.append(key)
-                        y.append(dict[key])
-                    lines = plot.plot(x,y)
-                    plot.ylabel("number of packets dropped")
-                    legend.append(name)
-
-                # Plot flow rates
-                if (globals.HOSTFLOWRATE not in s) and globals.FLOWRATE in s and globals.FLOWRATE == t:
-                    for key in sorted(dict.keys()):
-                        x.append(key)
-                        # converts flow rate from bps to Mbps
-                        y.append(dict[key]*globals.BITSTOMEGABITS)
-                    lines = plot.plot(x,y)
-                    plot.ylabel("flow rate (in Mbps)")
-                    legend.append(name)
-
-                # Plot window size
-                if globals.WINDOWSIZE in s and globals.WINDOWSIZE == t:
-                    for key in sorted(dict.keys()):
-                        x.append(key)
-                        y.append(dict[key])
-                    lines = plot.plot(x,y)
-                    plot.ylabel("window size")
-                    legend.append(name)
-
-                # Plot round trip times
-                if globals.FLOWRTT in s and globals.FLOWRTT == t:
-                    for key in sorted(dict.keys()):
-                        x.append(key)
-                        y.append(dict[key])
-                    lines = plot.plot(x,y)
-                    plot.ylabel("round trip time (in seconds)")
-                    legend.append(name)
-
-                # Plot per host flow rate
-                if globals.HOSTFLOWRATE in s and globals.HOSTFLOWRATE == t:
-                    for key in sorted(dict.keys()):
-                        x.append(key)
-                        y.append(dict[key]*globals.BITSTOMEGABITS)
-                    lines = plot.plot(x,y)
-                    plot.ylabel("flow rate (in Mbps)")
-                    legend.append(name)
-
-                if (lines != 0):
-                    if globals.PRESENTATIONMODE:
-                        plot.setp(lines, linewidth = 1)
-                    else:
-                        plot.setp(lines, linewidth = 0.5)
-                    plot.xlabel("time (in seconds)")
-
-
-            plot.title(t)
-            plot.legend(legend)
-            plotname = self.filename.split(".")[0] + " " + t
-            #if globals.PRESENTATIONMODE:
-                #plotname = plotname + " presentation"
-
-            plot.savefig(plotname, bbox_inches = "tight")
-            plot.gcf().clear()
-
-    # Function to actually run the simulator
-    def run(self):
-        # Make handshakes to learn routing table
-        for router in globals.idmapping['routers'].values():
-            router.send_handshake()
-
-        # Run the simulation for so many dt's
-        # For every dt
-        for i in range(self.duration):
-
-            # Send packets from links
-            for link in globals.idmapping['links'].values():
-                link.update_link_statistics()
-                link.send_packet()
-
-            # Send link states every 5 seconds
-            if (i+1) % 50000 == 0:
-                print("systime : ", globals.systime)
-
-                for router in globals.idmapping['routers'].values():
-                    router.recalc_link_state()
-
-            # Send out packets from the flows
-            for flow in globals.idmapping['flows'].values():
-                flow.run()
-                flow.update_flow_statistics()
-
-            # Increment the global clock
-            globals.systime += globals.dt
-
-        for flow in globals.idmapping['flows'].values():
+    # The figures are drawn in parallel, in up to workers processes, and only
+    # with the points that can be seen unless exact is set
+    def plot_metrics(self, workers=None, exact=False):
+        # If the metrics were streamed to disk, read them back in
+        # matplotlib is slow to import, so only load it when we plot
+        import plotting
+        if self.output is None:
+            store = self.context.statistics
+        else:
+            store = Results(self.output)
+        plotting.plot_metrics(store, self.filename.split(".")[0], \
+                              self.host_flows(), workers = workers, \
+                              exact = exact)
+
+    # Function to actually run the simulator. If until (in seconds) is given
+    # we stop there, and calling run again carries on from where we stopped.
+    def run(self, until=None):
+        if self.scheduler is None:
+            # Make handshakes to learn routing table
+            for router in self.context.idmapping['routers'].values():
+                router.send_handshake()
+
+            self.scheduler = TickScheduler(self.context, self.duration)
+
+        stop = None if until is None else int(round(until / globals.dt))
+        self.scheduler.run(stop)
+        if stop is not None and stop < self.duration:
+            return
+
+        for flow in self.context.idmapping['flows'].values():
             print(flow.states_tracker)
+
+        # Write out what is left of the metrics
+        if self.context.statistics.writer is not None:
+            self.context.statistics.writer.metadata["hostflows"] = self.host_flows()
+        self.context.statistics.close()
+
+    # Saves the whole state of a stopped run to filename, so that it can be
+    # carried on from there (any number of times) with restore()
+    def checkpoint(self, filename):
+        if self.context.statistics.writer is not None:
+            raise ValueError("runs streaming their metrics with --output "
+                             "can't be checkpointed")
+        with open(filename, "wb") as f:
+            CheckpointPickler(f, pickle.HIGHEST_PROTOCOL).dump(self)
+
+    # Raises ValueError if the flow can't be moved to start at start: once
+    # the run has started, only flows that haven't started yet can be moved,
+    # and only to after the current time
+    def check_flow_start(self, flowid, start):
+        flow = self.context.idmapping['flows'][flowid]
+        if (self.scheduler is not None and \
+            min(flow.start, start) < self.context.systime):
+            raise ValueError("flow " + flowid + " can only be moved to start "
+                             "after " + str(self.context.systime) + " s")
+
+    # Changes when a flow starts, in a run that has been stopped before the
+    # flow started
+    def set_flow_start(self, flowid, start):
+        self.check_flow_start(flowid, start)
+        flow = self.context.idmapping['flows'][flowid]
+        flow.start = start
+        if self.scheduler is not None:
+            self.scheduler.move_flow(flow)
+
+    # Changes the size of the buffer (in KB) on each side of a link. Packets
+    # already in a buffer that no longer fits them stay there, but no more
+    # are let in until it drains.
+    def set_buffer_size(self, linkid, buffersize):
+        link = self.context.idmapping['links'][linkid]
+        for halflink in link.links.values():
+            halflink.buffercapacity = buffersize * 8 * globals.KILOBITSTOBITS
+
+# Loads a run saved with Simulator.checkpoint
+def restore(filename):
+    with open(filename, "rb") as f:
+        return pickle.load(f)
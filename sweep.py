@@ -0,0 +1,349 @@
+# This file runs many simulations at once: a list of scenario files, each run
+# for every combination of a set of parameter values, or several different
+# continuations of one run saved with Simulator.checkpoint, spread over a
+# pool of worker processes. Only a summary of each run is kept.
+import contextlib
+import csv
+import io
+import itertools
+import json
+import os
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy
+
+import globals
+
+# The kinds of network objects a setting can change
+KINDS = ["links", "hosts", "routers", "flows"]
+
+# The settings that can still be changed once a run has started, and the
+# Simulator method that changes each of them
+BRANCHSETTINGS = {
+    ("flows", "start") : "set_flow_start",
+    ("links", "buffersize") : "set_buffer_size",
+}
+
+# The Simulator method that checks a value of each of those settings without
+# changing anything, for the settings that can't take every value
+BRANCHCHECKS = {
+    ("flows", "start") : "check_flow_start",
+}
+
+# The settings that only take certain values, and those values. Anything
+# else would be taken for the last of them by the Simulator.
+CHOICES = {
+    ("flows", "congestion_control") : ["reno", "fast"],
+}
+
+# The columns of the summary table, and their headings
+COLUMNS = [
+    ("scenario", "scenario"),
+    ("runtime", "runtime (s)"),
+    ("settings", "settings"),
+    ("status", "status"),
+    ("wall", "wall (s)"),
+    ("flows", "flows done"),
+    ("rate", "mean flow rate (Mbps)"),
+    ("rtt", "mean RTT (ms)"),
+    ("dropped", "packets dropped"),
+    ("buffer", "peak buffer (KB)"),
+]
+
+class JobTimeout(Exception):
+    pass
+
+
+def parse_value(text):
+    """This function turns a value given on the command line into a number if
+       it is one, and leaves it as a string otherwise."""
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def parse_setting(setting):
+    """This function parses a setting of the form KIND.ID.FIELD=V1,V2,...,
+       which sets FIELD of the object ID (or of every object, if ID is *) in
+       the KIND list of the scenario to each of the values in turn.
+       Returns ((kind, id, field), [values])."""
+    try:
+        (target, values) = setting.split("=", 1)
+        (kind, id, field) = target.split(".", 2)
+    except ValueError:
+        raise ValueError("settings are given as KIND.ID.FIELD=V1,V2,... "
+                         "but got " + setting)
+    if kind not in KINDS:
+        raise ValueError("unknown kind of network object " + kind + \
+                         " (use one of " + ", ".join(KINDS) + ")")
+    values = [parse_value(v) for v in values.split(",")]
+    for value in values:
+        if ((kind, field) in CHOICES and value not in CHOICES[(kind, field)]):
+            raise ValueError(kind + "." + id + "." + field + " can only be " + \
+                             " or ".join(CHOICES[(kind, field)]) + \
+                             ", not " + str(value))
+    return ((kind, id, field), values)
+
+
+def apply_settings(network, settings):
+    """This function changes the network objects loaded from a scenario file
+       according to settings, a list of ((kind, id, field), value)."""
+    for ((kind, id, field), value) in settings:
+        matched = False
+        for obj in network.get(kind, []):
+            if (id == "*" or obj.get("id") == id):
+                obj[field] = value
+                matched = True
+        if not matched:
+            raise ValueError("there is no " + kind + " " + id + " to set " + \
+                             field + " of")
+
+
+def branch_targets(sim, settings):
+    """This function checks that settings, a list of ((kind, id, field),
+       value), can all be applied to the stopped run sim, without changing
+       it. Raises ValueError if one can't.
+       Returns a list of (kind, field, object id, value), one for every
+       object each setting changes."""
+    targets = []
+    for ((kind, id, field), value) in settings:
+        if (kind, field) not in BRANCHSETTINGS:
+            raise ValueError("only " + ", ".join("%s.ID.%s" % s for s in \
+                             BRANCHSETTINGS) + " can be changed in a branch")
+        objects = sim.context.idmapping[kind]
+        ids = list(objects) if id == "*" else [id]
+        for i in ids:
+            if i not in objects:
+                raise ValueError("there is no " + kind + " " + i)
+            if (kind, field) in BRANCHCHECKS:
+                getattr(sim, BRANCHCHECKS[(kind, field)])(i, value)
+            targets.append((kind, field, i, value))
+    return targets
+
+
+def check_branches(sim, jobs):
+    """This function checks that every job from make_branches can be applied
+       to sim, the run restored from their snapshot, before any of them is
+       started. sim isn't changed, so it is restored only once for all of
+       them. Raises ValueError for the first one that can't."""
+    for job in jobs:
+        branch_targets(sim, job["settings"])
+
+
+def apply_changes(sim, settings):
+    """This function changes a stopped run according to settings, a list of
+       ((kind, id, field), value), for the settings in BRANCHSETTINGS."""
+    for (kind, field, i, value) in branch_targets(sim, settings):
+        getattr(sim, BRANCHSETTINGS[(kind, field)])(i, value)
+
+
+def describe(settings):
+    """This function returns settings as a short string for the table."""
+    return " ".join("%s.%s.%s=%s" % (kind, id, field, value) \
+                    for ((kind, id, field), value) in settings)
+
+
+def make_jobs(scenarios, grid, timeout=None):
+    """This function makes a job for every scenario with every combination of
+       the values in grid.
+       INPUT ARGUMENTS-
+           scenarios : A list of (input file, runtime in s)
+           grid : A list of ((kind, id, field), [values]), as parse_setting
+                  returns
+           timeout : The number of seconds of wall time each job may take
+       Returns a list of dictionaries, one per job, holding:
+           filename : The input file
+           runtime : How long to simulate for (in s)
+           settings : A list of ((kind, id, field), value) to apply
+           timeout : As given"""
+    targets = [target for (target, values) in grid]
+    jobs = []
+    for (filename, runtime) in scenarios:
+        for values in itertools.product(*[v for (t, v) in grid]):
+            jobs.append({
+                "filename" : filename,
+                "runtime" : runtime,
+                "settings" : list(zip(targets, values)),
+                "timeout" : timeout,
+            })
+    return jobs
+
+
+def make_branches(snapshot, runtime, branches, timeout=None):
+    """This function makes a job for every branch to run from a snapshot
+       saved with Simulator.checkpoint. Each branch is a list of settings as
+       parse_setting returns them, and gets a job for every combination of
+       their values. The jobs are the same as those from make_jobs, but with
+       snapshot (the file the run was saved to) in place of the settings of
+       the scenario file."""
+    jobs = []
+    for grid in branches:
+        for job in make_jobs([(snapshot, runtime)], grid, timeout):
+            job["snapshot"] = snapshot
+            jobs.append(job)
+    return jobs
+
+
+def mean(values):
+    """This function returns the mean of the recorded (non-NaN) values, or
+       None if there are none."""
+    values = values[~numpy.isnan(values)]
+    if (len(values) == 0):
+        return None
+    return float(values.mean())
+
+
+def summarize(sim):
+    """This function sums up a finished run for the summary table: how many
+       flows finished, the mean rate and RTT of the tracked flows, the packets
+       dropped on the tracked links, and the fullest any tracked buffer got."""
+    store = sim.context.statistics
+    flows = list(sim.context.idmapping['flows'].values())
+    rates = []
+    rtts = []
+    dropped = 0
+    buffer = None
+    for key in store.keys():
+        (first, values) = store.values(key)
+        metric = key.split(":")[-1]
+        if (metric == globals.FLOWRATE):
+            rates.append(mean(values))
+        elif (metric == globals.FLOWRTT):
+            rtts.append(mean(values))
+        elif (metric == globals.PACKETLOSS):
+            dropped += int(numpy.nansum(values))
+        elif (metric == globals.BUFFEROCCUPANCY and \
+              not numpy.isnan(values).all()):
+            buffer = max(buffer or 0, float(numpy.nanmax(values)))
+    rates = [r for r in rates if r is not None]
+    rtts = [r for r in rtts if r is not None]
+    return {
+        "flows" : "%d/%d" % (sum(1 for f in flows if f.completed()), \
+                             len(flows)),
+        "rate" : numpy.mean(rates) * globals.BITSTOMEGABITS if rates else None,
+        "rtt" : numpy.mean(rtts) * globals.STOMS if rtts else None,
+        "dropped" : dropped,
+        "buffer" : None if buffer is None else \
+                   buffer * globals.BITSTOKILOBITS / 8,
+    }
+
+
+def alarm(signum, frame):
+    raise JobTimeout()
+
+
+def run_job(job):
+    """This function runs a single job from make_jobs or make_branches and
+       returns its row of the summary table. It is run in the worker processes, each of which
+       runs job after job, so everything a run needs is made fresh here. The
+       run is stopped if it takes longer than its timeout (where the system
+       has SIGALRM), and whatever it prints is thrown away."""
+    from simulator import Simulator, restore
+    row = {"scenario" : job["filename"], "runtime" : job["runtime"],
+           "settings" : describe(job["settings"])}
+    timer = (job["timeout"] is not None and hasattr(signal, "SIGALRM"))
+    if timer:
+        previous = signal.signal(signal.SIGALRM, alarm)
+        signal.setitimer(signal.ITIMER_REAL, job["timeout"])
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            if "snapshot" in job:
+                sim = restore(job["snapshot"])
+                apply_changes(sim, job["settings"])
+            else:
+                with open(job["filename"]) as f:
+                    network = json.load(f)
+                apply_settings(network, job["settings"])
+                sim = Simulator(job["filename"], job["runtime"], \
+                                network = network)
+            sim.run()
+        row.update(summarize(sim))
+        row["status"] = "ok"
+    except JobTimeout:
+        row["status"] = "timeout"
+    except Exception as e:
+        row["status"] = "error: " + repr(e)
+    finally:
+        if timer:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+    row["wall"] = time.perf_counter() - start
+    return row
+
+
+def start_worker():
+    """This function sets up each worker process once, before its first
+       job, so that the imports aren't repeated for every job."""
+    globals.initialize()
+    import simulator
+
+
+def run_sweep(jobs, workers=None):
+    """This function runs every job, in up to workers processes (by default,
+       one per CPU), and returns their rows of the summary table in the order
+       of jobs. The longest runs are handed out first, so that the sweep
+       takes about as long as its slowest job when there are enough workers.
+       With one worker the jobs are run in this process."""
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(jobs))
+    order = sorted(range(len(jobs)), key = lambda i: -jobs[i]["runtime"])
+    rows = [None] * len(jobs)
+    if (workers <= 1):
+        for i in order:
+            rows[i] = run_job(jobs[i])
+            print(format_progress(rows[i]))
+        return rows
+
+    with ProcessPoolExecutor(max_workers = workers, \
+                             initializer = start_worker) as pool:
+        futures = {pool.submit(run_job, jobs[i]) : i for i in order}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                rows[i] = future.result()
+            except Exception as e:
+                # The worker itself died (for example, it ran out of memory)
+                rows[i] = {"scenario" : jobs[i]["filename"],
+                           "runtime" : jobs[i]["runtime"],
+                           "settings" : describe(jobs[i]["settings"]),
+                           "status" : "failed: " + repr(e)}
+            print(format_progress(rows[i]))
+    return rows
+
+
+def format_progress(row):
+    return "finished %s %s: %s" % (row["scenario"], row["settings"], \
+                                   row["status"])
+
+
+def format_cell(value):
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return "%.3f" % value
+    return str(value)
+
+
+def format_table(rows):
+    """This function lays the summary rows out as a text table."""
+    table = [[heading for (key, heading) in COLUMNS]]
+    for row in rows:
+        table.append([format_cell(row.get(key)) for (key, heading) in COLUMNS])
+    widths = [max(len(line[c]) for line in table) for c in range(len(COLUMNS))]
+    return "\n".join("  ".join(cell.ljust(w) for (cell, w) in \
+                               zip(line, widths)).rstrip() for line in table)
+
+
+def write_csv(rows, filename):
+    """This function saves the summary rows as a CSV file."""
+    with open(filename, "w", newline = "") as f:
+        writer = csv.writer(f)
+        writer.writerow([heading for (key, heading) in COLUMNS])
+        for row in rows:
+            writer.writerow(["" if row.get(key) is None else row.get(key) \
+                             for (key, heading) in COLUMNS])
@@ -0,0 +1,94 @@
+# Checks that the shortest paths a Router keeps up to date as link states
+# change are the same as the ones it works out from scratch, on random
+# networks.
+#     example: python3 -m pytest test_router.py
+import random
+
+# globals pulls in the rest of the simulator in the order it needs
+import globals
+from router import Router
+
+class FakeLink:
+    """Just enough of a Link for a router to build its forwarding table."""
+    def __init__(self, id, a, b):
+        self.id = id
+        self.links = {a : (id, a), b : (id, b)}
+
+
+def random_network(rng, size, degree):
+    """Returns the (source, destination, link id) of both directions of
+       every connection of a random connected network of size routers."""
+    routers = ["R%d" % i for i in range(size)]
+    pairs = set()
+    # A random tree, so everything can be reached, and then some more
+    for i in range(1, size):
+        pairs.add((routers[rng.randrange(i)], routers[i]))
+    for _ in range(size * (degree - 1)):
+        (a, b) = rng.sample(routers, 2)
+        if (b, a) not in pairs:
+            pairs.add((a, b))
+    connections = []
+    for (n, (a, b)) in enumerate(sorted(pairs)):
+        connections.append((a, b, "L%d" % n))
+        connections.append((b, a, "L%d" % n))
+    return connections
+
+
+def from_scratch(router):
+    """Returns a router with the link state database of router, which has
+       worked out its shortest paths from scratch."""
+    fresh = Router(None, router.id, router.links)
+    for (src, entries) in router.lsdb.items():
+        for (dst, (linkid, cost)) in entries.items():
+            fresh.set_link_state(src, dst, linkid, cost)
+    fresh.run_dijkstra()
+    return fresh
+
+
+def check(seed, size, degree, costs, changes):
+    """Changes the cost of random connections of a random network changes
+       times, a few at a time, checking the router's shortest paths against
+       ones worked out from scratch after every change. costs makes a random
+       cost; small whole numbers give lots of paths that cost the same."""
+    rng = random.Random(seed)
+    connections = random_network(rng, size, degree)
+    links = [FakeLink(linkid, a, b) for (a, b, linkid) in connections \
+             if a == "R0"]
+    router = Router(None, "R0", links)
+    for (src, dst, linkid) in connections:
+        router.set_link_state(src, dst, linkid, costs(rng))
+    router.run_dijkstra()
+    for _ in range(changes):
+        changed = []
+        for (src, dst, linkid) in rng.sample(connections, \
+                                             rng.randint(1, 3)):
+            if router.set_link_state(src, dst, linkid, costs(rng)):
+                changed.append((src, dst))
+        if changed:
+            router.update_routes(changed)
+        fresh = from_scratch(router)
+        assert router.dist == fresh.dist
+        assert router.parent == fresh.parent
+        assert router.routing_table == fresh.routing_table
+        assert router.fib == fresh.fib
+
+
+def test_distinct_costs():
+    for seed in range(30):
+        check(seed, 12, 3, lambda rng: rng.uniform(0.01, 10), 200)
+
+
+def test_equal_costs():
+    # Most shortest paths have others that cost the same, so this checks
+    # that the same one is picked either way
+    for seed in range(30):
+        check(seed, 12, 3, lambda rng: rng.randint(1, 3), 200)
+
+
+def test_link_state_costs():
+    # Costs like the ones the routers work out: the delay of the link plus
+    # its effective rate, which is often 0
+    delays = [10, 10, 10, 20]
+    for seed in range(30):
+        check(seed, 10, 3, lambda rng: rng.choice(delays) + \
+              rng.choice([0, 0, rng.uniform(0, 1e7)]), 200)
@@ -0,0 +1,111 @@
+# Checks the TimerWheel against a plain heap of deadlines, with random timers
+# that are set, moved and cancelled while the wheel turns.
+#     example: python3 -m pytest test_timerwheel.py
+import heapq
+import random
+
+from timerwheel import TimerWheel
+
+class HeapTimers:
+    """The timers of a TimerWheel, kept the simple way: a dictionary of
+       owner : deadline, and a heap of (deadline, owner) entries, some of
+       which have gone stale."""
+    def __init__(self, now):
+        self.now = now
+        self.deadlines = {}
+        self.heap = []
+
+    def schedule(self, owner, deadline):
+        self.deadlines[owner] = deadline
+        heapq.heappush(self.heap, (deadline, owner))
+
+    def cancel(self, owner):
+        self.deadlines.pop(owner, None)
+
+    def advance(self, tick):
+        """Returns the (deadline, owner) of every timer that goes off by
+           tick, earliest first."""
+        self.now = tick
+        expired = []
+        while self.heap and self.heap[0][0] <= tick:
+            (deadline, owner) = heapq.heappop(self.heap)
+            if (self.deadlines.get(owner) == deadline):
+                del self.deadlines[owner]
+                expired.append((deadline, owner))
+        return expired
+
+    def next_expiry(self):
+        if not self.deadlines:
+            return None
+        return min(self.deadlines.values())
+
+
+def check(wheel, seed, steps, owners, spans):
+    """Makes steps random changes to wheel and to a HeapTimers, checking
+       that they agree after every one. Deadlines are set at most a random
+       one of spans timesteps ahead, and the wheel is moved on by up to
+       that much too."""
+    rng = random.Random(seed)
+    timers = HeapTimers(wheel.now)
+    for _ in range(steps):
+        action = rng.random()
+        owner = rng.randrange(owners)
+        if (action < 0.5):
+            deadline = wheel.now + rng.randint(1, rng.choice(spans))
+            wheel.schedule(owner, deadline)
+            timers.schedule(owner, deadline)
+        elif (action < 0.6):
+            # Moving a timer to where it already is changes nothing
+            deadline = timers.deadlines.get(owner)
+            if deadline is not None:
+                wheel.schedule(owner, deadline)
+        elif (action < 0.7):
+            wheel.cancel(owner)
+            timers.cancel(owner)
+        else:
+            tick = wheel.now + rng.randint(0, rng.choice(spans))
+            # Timers that go off in the same timestep can come in any order
+            deadlines = dict(timers.deadlines)
+            expired = wheel.advance(tick)
+            expected = timers.advance(tick)
+            assert sorted(expired) == sorted(o for (d, o) in expected)
+            order = [deadlines[o] for o in expired]
+            assert order == sorted(order)
+            assert wheel.now == tick
+        assert wheel.next_expiry() == timers.next_expiry()
+        assert len(wheel) == len(timers.deadlines)
+        for o in range(owners):
+            assert (o in wheel) == (o in timers.deadlines)
+            assert wheel.deadline(o) == timers.deadlines.get(o)
+
+
+def test_lowest_level():
+    # Everything fits in the first level
+    for seed in range(20):
+        check(TimerWheel(), seed, 2000, 8, [1, 10, 63])
+
+
+def test_level_boundaries():
+    # Deadlines in every level of the default wheel, starting just before
+    # the second and third levels turn over
+    for (seed, now) in enumerate([0, 4095 - 3, 262143 - 5]):
+        check(TimerWheel(now = now), seed, 3000, 16, \
+              [1, 64, 4096, 100000, 262144])
+
+
+def test_overflow():
+    # A wheel of 3 levels of 2 bits covers 64 timesteps, so most of these
+    # deadlines start out in the overflow list
+    for seed in range(20):
+        check(TimerWheel(bits = 2, levels = 3), seed, 3000, 16, \
+              [1, 4, 16, 64, 200, 1000])
+
+
+def test_past_deadline():
+    wheel = TimerWheel(now = 10)
+    try:
+        wheel.schedule(0, 10)
+    except ValueError:
+        pass
+    else:
+        assert False, "a deadline that isn't after now was accepted"
@@ -0,0 +1,191 @@
+# Number of bits of the deadline each level of the wheel covers, and the
+# number of levels. With 6 bits and 4 levels the wheel covers 2^24 timesteps
+# (about 28 minutes of simulated time) before timers go in the overflow list.
+BITS = 6
+LEVELS = 4
+
+class TimerWheel:
+    def __init__(self, bits=BITS, levels=LEVELS, now=0):
+        """This function initializes a hierarchical timer wheel, which holds
+           one timer (a deadline, in timesteps) for each of any number of
+           owners. Setting, moving and cancelling a timer is O(1), and
+           advance() only touches the timers that expire, plus the ones that
+           move down a level as the wheel turns, which each timer does at
+           most once per level.
+
+           Level 0 has one slot per timestep for the current rotation of
+           2^bits timesteps. Each level above has one slot per rotation of
+           the level below, so a timer starts at the lowest level its
+           deadline fits in and is moved down when the wheel reaches its
+           slot. Timers that are moved or cancelled are left where they are
+           and ignored when their slot comes up.
+           INPUT ARGUMENTS-
+               bits : The number of bits of the deadline each level covers
+               levels : The number of levels
+               now : The timestep the wheel starts at
+           FIELDS-
+               now : The last timestep advanced to
+               wheels : wheels[level][slot] is a list of (owner, deadline)
+               counts : The number of entries in each level
+               overflow : Entries too far away for the top level
+               deadlines : The current deadline of each owner with a timer
+               earliest : The earliest deadline, or None if it needs to be
+                          worked out again"""
+        self.bits = bits
+        self.size = 1 << bits
+        self.mask = self.size - 1
+        self.levels = levels
+        self.now = now
+        self.wheels = [[[] for _ in range(self.size)] for _ in range(levels)]
+        self.counts = [0] * levels
+        self.overflow = []
+        self.deadlines = {}
+        self.earliest = None
+
+
+    def __len__(self):
+        return len(self.deadlines)
+
+
+    def __contains__(self, owner):
+        return owner in self.deadlines
+
+
+    def insert(self, owner, deadline):
+        """This function puts an entry in the lowest level that can hold it."""
+        for level in range(self.levels):
+            shift = self.bits * (level + 1)
+            # It fits in this level if it is in the current rotation of the
+            # level above
+            if (deadline >> shift) == (self.now >> shift):
+                slot = (deadline >> (self.bits * level)) & self.mask
+                self.wheels[level][slot].append((owner, deadline))
+                self.counts[level] += 1
+                return
+        self.overflow.append((owner, deadline))
+
+
+    def schedule(self, owner, deadline):
+        """This function sets the timer of owner to go off at timestep
+           deadline, which must be after the current one, replacing any
+           timer it already had."""
+        if (deadline <= self.now):
+            raise ValueError("timer deadline %d is not after timestep %d" % \
+                             (deadline, self.now))
+        previous = self.deadlines.get(owner)
+        if (previous == deadline):
+            return
+        self.deadlines[owner] = deadline
+        self.insert(owner, deadline)
+        if (previous is not None and previous == self.earliest):
+            # The earliest timer was this one, and it has moved. If it moved
+            # sooner, or it is the only one, it is still the earliest.
+            if (deadline < previous or len(self.deadlines) == 1):
+                self.earliest = deadline
+            else:
+                self.earliest = None
+        elif (self.earliest is not None and deadline < self.earliest):
+            self.earliest = deadline
+
+
+    def cancel(self, owner):
+        """This function removes the timer of owner, if it has one."""
+        deadline = self.deadlines.pop(owner, None)
+        if (deadline is not None and deadline == self.earliest):
+            self.earliest = None
+
+
+    def deadline(self, owner):
+        """This function returns the deadline of owner's timer, or None."""
+        return self.deadlines.get(owner)
+
+
+    def cascade(self, level):
+        """This function moves the entries in the current slot of level down
+           to the levels below, dropping the ones that are out of date."""
+        slot = (self.now >> (self.bits * level)) & self.mask
+        entries = self.wheels[level][slot]
+        self.wheels[level][slot] = []
+        self.counts[level] -= len(entries)
+        for (owner, deadline) in entries:
+            if (self.deadlines.get(owner) == deadline):
+                self.insert(owner, deadline)
+
+
+    def turn(self):
+        """This function moves the wheel on to timestep now, bringing down
+           the timers of every level that starts a new rotation."""
+        top = self.bits * self.levels
+        if (self.now & ((1 << top) - 1) == 0):
+            entries = self.overflow
+            self.overflow = []
+            for (owner, deadline) in entries:
+                if (self.deadlines.get(owner) == deadline):
+                    self.insert(owner, deadline)
+        for level in range(self.levels - 1, 0, -1):
+            if (self.now & ((1 << (self.bits * level)) - 1) == 0):
+                self.cascade(level)
+
+
+    def advance(self, tick):
+        """This function moves the wheel on to timestep tick, and returns the
+           owners whose timers went off at or before it, in the order they
+           went off. Their timers are removed."""
+        expired = []
+        while self.now < tick:
+            # Find the lowest level with any timers in it. Nothing can go off
+            # before that level's next slot comes up, so skip straight to it
+            # (or to tick, if that's sooner).
+            level = 0
+            while (level < self.levels and self.counts[level] == 0):
+                level += 1
+            if (level == self.levels and not self.overflow):
+                self.now = tick
+                break
+            if (level > 0):
+                shift = self.bits * level
+                self.now = min(tick, ((self.now >> shift) + 1) << shift) - 1
+
+            self.now += 1
+            if (self.now & self.mask == 0):
+                self.turn()
+            slot = self.now & self.mask
+            entries = self.wheels[0][slot]
+            if entries:
+                self.wheels[0][slot] = []
+                self.counts[0] -= len(entries)
+                for (owner, deadline) in entries:
+                    if (self.deadlines.get(owner) == deadline):
+                        del self.deadlines[owner]
+                        expired.append(owner)
+        if (self.earliest is not None and self.earliest <= self.now):
+            self.earliest = None
+        return expired
+
+
+    def next_expiry(self):
+        """This function returns the earliest deadline of any timer, or None
+           if there are no timers."""
+        if (self.earliest is not None):
+            return self.earliest
+        if not self.deadlines:
+            return None
+        # Every timer in a level goes off before every timer in the levels
+        # above it, so the first slot with a live timer has the earliest one.
+        for level in range(self.levels):
+            if (self.counts[level] == 0):
+                continue
+            shift = self.bits * level
+            current = (self.now >> shift) & self.mask
+            wheel = self.wheels[level]
+            for slot in range(current, self.size):
+                if not wheel[slot]:
+                    continue
+                live = [deadline for (owner, deadline) in wheel[slot] \
+                        if self.deadlines.get(owner) == deadline]
+                if live:
+                    self.earliest = min(live)
+                    return self.earliest
+        self.earliest = min(deadline for (owner, deadline) in self.overflow \
+                            if self.deadlines.get(owner) == deadline)
+        return self.earliest